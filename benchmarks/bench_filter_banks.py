@@ -0,0 +1,40 @@
+'''
+Author: Dan Valente
+
+Benchmarks of building the filter banks.  The banks are cached, so the
+caches are cleared before every call to time construction rather than
+lookup.  See bench_transforms for the conventions.
+'''
+
+from pythagoras.filter_banks import constq, mel
+from pythagoras.filter_banks.constq import _constq
+from pythagoras.filter_banks.mel import _mel
+from pythagoras.benchmarks.common import FS, DTYPES
+
+
+class Constq(object):
+    params = [[8192, 32768], [False, True], DTYPES]
+    param_names = ['nfft', 'sparse', 'dtype']
+
+    def time_constq(self, nfft, sparse, dtype):
+        _constq.cache_clear()
+        constq(110, 17, 12, FS, nfft, one_sided=True, sparse=sparse,
+               dtype=dtype)
+
+    def peakmem_constq(self, nfft, sparse, dtype):
+        _constq.cache_clear()
+        constq(110, 17, 12, FS, nfft, one_sided=True, sparse=sparse,
+               dtype=dtype)
+
+
+class Mel(object):
+    params = [[2048, 8192, 32768], [40, 128], [False, True]]
+    param_names = ['nfft', 'nfilt', 'sparse']
+
+    def time_mel(self, nfft, nfilt, sparse):
+        _mel.cache_clear()
+        mel(0, FS, nfilt, nfft, sparse)
+
+    def peakmem_mel(self, nfft, nfilt, sparse):
+        _mel.cache_clear()
+        mel(0, FS, nfilt, nfft, sparse)
@@ -0,0 +1,32 @@
+'''
+Author: Dan Valente
+
+Benchmarks of importing the package in a fresh interpreter, which short
+lived worker processes pay on every start.  Optional heavy dependencies
+(plotting, NMF solvers, most of scipy) should only be imported by the
+functions that use them.  See bench_transforms for the conventions;
+timeraw_* methods return code that is timed in a new interpreter, and
+track_* methods return the value to record.
+'''
+
+from pythagoras.benchmarks.common import python
+
+# Modules that importing pythagoras should not load
+_heavy = ('matplotlib', 'sklearn', 'nimfa', 'scipy.fft', 'scipy.io',
+          'scipy.signal', 'scipy.sparse', 'scipy.stats')
+
+
+class Import(object):
+    params = [['pythagoras.transforms', 'pythagoras.filter_banks',
+               'pythagoras.separate', 'pythagoras.utils.batch']]
+    param_names = ['module']
+
+    def timeraw_import(self, module):
+        return 'import %s' % module
+
+    def track_heavy_modules(self, module):
+        code = ('import sys\nimport %s\n'
+                'print(sum(m in sys.modules for m in %r))' % (module, _heavy))
+        return int(python(code))
+
+    track_heavy_modules.unit = 'modules'
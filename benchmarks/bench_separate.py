@@ -0,0 +1,111 @@
+'''
+Author: Dan Valente
+
+Benchmarks of NMF and source separation on the magnitude spectrograms
+of a few seconds of random chords.  See bench_transforms for the conventions.
+'''
+
+import numpy as np
+from pythagoras.transforms import stft
+from pythagoras.separate import nmf, OnlineNMF, separate
+from pythagoras.benchmarks.common import signal
+
+
+def _spectrogram(seconds):
+    x = signal('tones', seconds)
+    S = np.abs(stft(x, 2048, 512, nfft=2048, taper_name='hanning',
+                    one_sided=True)[0])
+
+    return S, len(x)
+
+
+class NMF(object):
+    params = [[4, 16], [2, 8], ['mu', 'hals', 'sklearn']]
+    param_names = ['seconds', 'rank', 'method']
+
+    def setup(self, seconds, rank, method):
+        if method == 'sklearn':
+            try:
+                import sklearn
+            except ImportError:
+                # Skipped (as in asv) without the NMF dependencies
+                raise NotImplementedError
+            self.kwargs = dict(n_components=rank, init='nndsvd',
+                               max_iter=200)
+        else:
+            self.kwargs = dict(n_components=rank, max_iter=200, tol=0,
+                               random_state=0)
+
+        self.S, self.n_samples = _spectrogram(seconds)
+
+    def time_nmf(self, seconds, rank, method):
+        nmf(self.S, method, **self.kwargs)
+
+    def peakmem_nmf(self, seconds, rank, method):
+        nmf(self.S, method, **self.kwargs)
+
+
+class FixedBasis(object):
+    # Activations of a batch of clips over one learned dictionary
+    params = [[1, 16, 64], ['mu', 'hals']]
+    param_names = ['n_clips', 'method']
+
+    def setup(self, n_clips, method):
+        S, n = _spectrogram(n_clips)
+        n_frames = S.shape[1] // n_clips
+        self.S = np.stack([S[:, i * n_frames:(i + 1) * n_frames]
+                           for i in range(n_clips)])
+        self.W = nmf(S, 'mu', n_components=16, max_iter=50,
+                     random_state=0)[0]
+        self.n_samples = n
+
+    def time_fixed_basis(self, n_clips, method):
+        nmf(self.S, method, basis=self.W, fix_basis=True, max_iter=100,
+            tol=0)
+
+    def peakmem_fixed_basis(self, n_clips, method):
+        nmf(self.S, method, basis=self.W, fix_basis=True, max_iter=100,
+            tol=0)
+
+
+class Online(object):
+    # One pass over a spectrogram in minibatches of 64 frames.  Frames
+    # are 512 samples apart, so frames/s is the throughput / 512.
+    params = [[2, 1, 0]]
+    param_names = ['beta']
+
+    def setup(self, beta):
+        S, self.n_samples = _spectrogram(16)
+        self.batches = [S[:, i:i + 64] for i in range(0, S.shape[1], 64)]
+
+    def time_partial_fit(self, beta):
+        model = OnlineNMF(16, beta=beta, random_state=0)
+        for X in self.batches:
+            model.partial_fit(X)
+
+    def peakmem_partial_fit(self, beta):
+        model = OnlineNMF(16, beta=beta, random_state=0)
+        for X in self.batches:
+            model.partial_fit(X)
+
+
+class Separate(object):
+    # The whole pipeline over a learned dictionary, at once or in
+    # blocks of 256 frames
+    params = [[4, 16], ['all', 'blocks']]
+    param_names = ['seconds', 'mode']
+
+    def setup(self, seconds, mode):
+        self.x = signal('tones', seconds)
+        self.n_samples = len(self.x)
+        self.W = nmf(_spectrogram(4)[0], 'mu', n_components=8, max_iter=50,
+                     random_state=0)[0]
+        self.block_frames = 256 if mode == 'blocks' else None
+
+    def time_separate(self, seconds, mode):
+        separate(self.x, basis=self.W, fix_basis=True, max_iter=50,
+                 block_frames=self.block_frames)
+
+    def peakmem_separate(self, seconds, mode):
+        separate(self.x, basis=self.W, fix_basis=True, max_iter=50,
+                 block_frames=self.block_frames)
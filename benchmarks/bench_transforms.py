@@ -0,0 +1,263 @@
+'''
+Author: Dan Valente
+
+Benchmarks of the transforms.  Classes follow the asv conventions:
+setup() builds the inputs for one combination of params, time_*
+methods are timed and peakmem_* methods have their peak memory
+measured.  Every class sets n_samples, from which the runner reports
+throughput in samples per second.
+'''
+
+import shutil
+import tempfile
+
+import numpy as np
+from pythagoras.transforms import (tfft, stft, istft, cqt, ceps, mfcc,
+                                   resample, FeaturePlan)
+from pythagoras.utils import utils, cache
+from pythagoras.benchmarks.common import (signal, SECONDS, NFFTS, HOPS,
+                                          DTYPES)
+
+
+class TFFT(object):
+    # A batch of half-overlapping frames of a 4 second sweep, as stft
+    # would pass to tfft
+    params = [NFFTS, DTYPES]
+    param_names = ['nfft', 'dtype']
+
+    def setup(self, nfft, dtype):
+        x = signal('sweep', 4)
+        self.frames = utils.frame(x, nfft, nfft // 2)
+        self.n_samples = len(x)
+
+    def time_tfft(self, nfft, dtype):
+        tfft(self.frames, nfft, 'hanning', one_sided=True, dtype=dtype)
+
+    def peakmem_tfft(self, nfft, dtype):
+        tfft(self.frames, nfft, 'hanning', one_sided=True, dtype=dtype)
+
+
+class STFT(object):
+    params = [SECONDS, NFFTS, HOPS, DTYPES]
+    param_names = ['seconds', 'nfft', 'hop', 'dtype']
+
+    def setup(self, seconds, nfft, hop, dtype):
+        self.x = signal('sweep', seconds)
+        self.n_samples = len(self.x)
+
+    def time_stft(self, seconds, nfft, hop, dtype):
+        stft(self.x, nfft, int(nfft * hop), nfft=nfft, taper_name='hanning',
+             one_sided=True, dtype=dtype)
+
+    def peakmem_stft(self, seconds, nfft, hop, dtype):
+        stft(self.x, nfft, int(nfft * hop), nfft=nfft, taper_name='hanning',
+             one_sided=True, dtype=dtype)
+
+
+class ISTFT(object):
+    params = [SECONDS, NFFTS, HOPS, DTYPES]
+    param_names = ['seconds', 'nfft', 'hop', 'dtype']
+
+    def setup(self, seconds, nfft, hop, dtype):
+        x = signal('sweep', seconds)
+        self.S = stft(x, nfft, int(nfft * hop), nfft=nfft,
+                      taper_name='hanning', one_sided=True, dtype=dtype)[0]
+        self.n_samples = len(x)
+
+    def time_istft(self, seconds, nfft, hop, dtype):
+        istft(self.S, nfft, int(nfft * hop), nfft=nfft, taper_name='hanning',
+              one_sided=True)
+
+    def peakmem_istft(self, seconds, nfft, hop, dtype):
+        istft(self.S, nfft, int(nfft * hop), nfft=nfft, taper_name='hanning',
+              one_sided=True)
+
+
+class CQT(object):
+    # fmin and Q are chosen so that the longest kernel fits in nfft
+    params = [SECONDS, ['dense', 'sparse', 'multires'], DTYPES]
+    param_names = ['seconds', 'kernel', 'dtype']
+
+    def setup(self, seconds, kernel, dtype):
+        self.x = signal('tones', seconds)
+        self.n_samples = len(self.x)
+        self.kwargs = dict(frame_size=8192, step_size=2048, nfft=8192,
+                           fmin=110, Q=17, n=12, one_sided=True,
+                           sparse=kernel == 'sparse',
+                           multires=kernel == 'multires', dtype=dtype)
+
+    def time_cqt(self, seconds, kernel, dtype):
+        cqt(self.x, **self.kwargs)
+
+    def peakmem_cqt(self, seconds, kernel, dtype):
+        cqt(self.x, **self.kwargs)
+
+
+class MFCC(object):
+    params = [SECONDS, NFFTS, DTYPES]
+    param_names = ['seconds', 'nfft', 'dtype']
+
+    def setup(self, seconds, nfft, dtype):
+        self.x = signal('tones', seconds)
+        self.n_samples = len(self.x)
+
+    def time_mfcc(self, seconds, nfft, dtype):
+        mfcc(self.x, nfft=nfft, n_coeffs=13, framewise=True, frame_size=nfft,
+             step_size=nfft // 4, taper_name='hamming', dtype=dtype)
+
+    def peakmem_mfcc(self, seconds, nfft, dtype):
+        mfcc(self.x, nfft=nfft, n_coeffs=13, framewise=True, frame_size=nfft,
+             step_size=nfft // 4, taper_name='hamming', dtype=dtype)
+
+
+class Ceps(object):
+    # Cepstrum of the whole signal, with nfft the next power of 2
+    params = [SECONDS, DTYPES]
+    param_names = ['seconds', 'dtype']
+
+    def setup(self, seconds, dtype):
+        self.x = signal('tones', seconds)
+        self.n_samples = len(self.x)
+
+    def time_ceps(self, seconds, dtype):
+        ceps(self.x, which_type='real', dtype=dtype)
+
+    def peakmem_ceps(self, seconds, dtype):
+        ceps(self.x, which_type='real', dtype=dtype)
+
+
+class Cepstrogram(object):
+    # Framewise cepstrum, in full or truncated to 40 quefrency bins
+    params = [SECONDS, [None, 40]]
+    param_names = ['seconds', 'n_quef']
+
+    def setup(self, seconds, n_quef):
+        self.x = signal('tones', seconds)
+        self.n_samples = len(self.x)
+
+    def time_cepstrogram(self, seconds, n_quef):
+        ceps(self.x, framewise=True, frame_size=2048, step_size=512,
+             taper_name='hanning', which_type='real', n_quef=n_quef)
+
+    def peakmem_cepstrogram(self, seconds, n_quef):
+        ceps(self.x, framewise=True, frame_size=2048, step_size=512,
+             taper_name='hanning', which_type='real', n_quef=n_quef)
+
+
+class MTM(object):
+    # Multitaper spectrogram with the default 7 tapers (NW=4)
+    params = [SECONDS, [False, True]]
+    param_names = ['seconds', 'adaptive']
+
+    def setup(self, seconds, adaptive):
+        self.x = signal('tones', seconds)
+        self.n_samples = len(self.x)
+
+    def time_stft_mtm(self, seconds, adaptive):
+        stft(self.x, 2048, 512, nfft=2048, taper_name='mtm', one_sided=True,
+             adaptive=adaptive)
+
+    def peakmem_stft_mtm(self, seconds, adaptive):
+        stft(self.x, 2048, 512, nfft=2048, taper_name='mtm', one_sided=True,
+             adaptive=adaptive)
+
+
+class SDFT(object):
+    # Spectrogram of 1 second at small steps, at a few bins or every
+    # 8th bin, by FFT or sliding DFT
+    params = [[1, 4, 16], [4, 129], ['fft', 'sdft']]
+    param_names = ['hop', 'n_bins', 'method']
+
+    def setup(self, hop, n_bins, method):
+        self.x = signal('tones', 1)
+        self.n_samples = len(self.x)
+        self.bins = np.linspace(0, 1024, n_bins).astype(int)
+
+    def time_stft(self, hop, n_bins, method):
+        stft(self.x, 2048, hop, nfft=2048, taper_name='hanning',
+             one_sided=True, bins=self.bins, method=method)
+
+    def peakmem_stft(self, hop, n_bins, method):
+        stft(self.x, 2048, hop, nfft=2048, taper_name='hanning',
+             one_sided=True, bins=self.bins, method=method)
+
+
+class Resample(object):
+    # Speech mfcc (25 ms frames every 10 ms) of a 44.1 kHz signal, at
+    # that rate or after resampling to fs_out
+    params = [SECONDS, [None, 22050, 16000]]
+    param_names = ['seconds', 'fs_out']
+
+    def setup(self, seconds, fs_out):
+        self.x = signal('tones', seconds)
+        self.n_samples = len(self.x)
+        fs = 44100 if fs_out is None else fs_out
+        self.plan = FeaturePlan(fs=44100, frame_size=int(0.025 * fs),
+                                step_size=int(0.01 * fs),
+                                taper_name='hamming', fs_out=fs_out)
+        self.plan.add('mfcc', n_coeffs=13)
+
+    def time_resample(self, seconds, fs_out):
+        if fs_out is not None:
+            resample(self.x, 44100, fs_out)
+
+    def time_mfcc_plan(self, seconds, fs_out):
+        self.plan.run(self.x)
+
+    def peakmem_mfcc_plan(self, seconds, fs_out):
+        self.plan.run(self.x)
+
+
+class Multichannel(object):
+    # STFT and mfcc of an 8 channel recording, a channel at a time or
+    # all channels in one call
+    params = [SECONDS, ['loop', 'stacked']]
+    param_names = ['seconds', 'mode']
+
+    def setup(self, seconds, mode):
+        x = signal('tones', seconds)
+        self.x = np.stack([np.roll(x, 100 * c) for c in range(8)])
+        self.n_samples = self.x.size
+
+    def _apply(self, func, mode, **kwargs):
+        if mode == 'loop':
+            return [func(channel, **kwargs) for channel in self.x]
+        return func(self.x, **kwargs)
+
+    def time_stft(self, seconds, mode):
+        self._apply(stft, mode, frame_size=1024, step_size=256,
+                    taper_name='hanning', one_sided=True)
+
+    def time_mfcc(self, seconds, mode):
+        self._apply(mfcc, mode, framewise=True, frame_size=1024,
+                    step_size=256, n_coeffs=13, taper_name='hamming')
+
+    def peakmem_stft(self, seconds, mode):
+        self._apply(stft, mode, frame_size=1024, step_size=256,
+                    taper_name='hanning', one_sided=True)
+
+
+class Cache(object):
+    # stft and mfcc computed, or answered from a warm disk cache
+    params = [SECONDS, ['off', 'hit']]
+    param_names = ['seconds', 'cache']
+
+    def setup(self, seconds, mode):
+        self.x = signal('tones', seconds)
+        self.n_samples = len(self.x)
+        self.directory = tempfile.mkdtemp()
+        if mode == 'hit':
+            cache.set_cache(self.directory)
+            self.time_stft(seconds, mode)
+            self.time_mfcc(seconds, mode)
+
+    def teardown(self, seconds, mode):
+        cache.set_cache(None)
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def time_stft(self, seconds, mode):
+        stft(self.x, 2048, 512, taper_name='hanning', one_sided=True)
+
+    def time_mfcc(self, seconds, mode):
+        mfcc(self.x, framewise=True, frame_size=1024, step_size=256,
+             n_coeffs=13, taper_name='hamming')
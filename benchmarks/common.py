@@ -0,0 +1,68 @@
+'''
+Author: Dan Valente
+
+Deterministic test signals and parameter grids shared by the
+benchmarks.
+'''
+
+import os
+import subprocess
+import sys
+
+import numpy as np
+from pythagoras.utils import fungen
+
+FS = 44100
+
+# Parameter grids.  Signal lengths are in seconds at FS.
+SECONDS = [1, 4, 16]
+NFFTS = [512, 2048, 8192]
+HOPS = [0.5, 0.25]
+DTYPES = ['float64', 'float32']
+
+
+def signal(kind='sweep', seconds=1, fs=FS):
+    """
+        signal(kind='sweep', seconds=1, fs=FS)
+            A deterministic test signal from utils.fungen.
+
+        Input
+        -----
+            kind:       'sine' (440 Hz), 'sweep' (linear, 100 Hz to
+                        fs/4) or 'tones' (random chords of up to four
+                        tones a second, from a fixed seed)
+            seconds:    length of the signal in seconds
+            fs:         sample rate
+
+        Returns
+        -------
+            x     [np.array]
+    """
+
+    if kind == 'sine':
+        x = fungen.sine_wave(440., length=seconds, fs=fs)[0]
+    elif kind == 'sweep':
+        x = fungen.linear_sweep(100., fs/4., length=seconds, fs=fs)[0]
+    elif kind == 'tones':
+        np.random.seed(0)
+        x = fungen.rand_tones(max_tones_per_interval=4,
+                              n_intervals=seconds, fs=fs)
+    else:
+        raise ValueError("Unknown signal '%s'. Choices are: sine, sweep, "
+                         "tones" % kind)
+
+    return x
+
+
+def python(code):
+    """
+        python(code)
+            Runs code in a fresh interpreter, with the same sys.path as
+            this one, and returns what it prints.
+    """
+
+    path = [p or os.getcwd() for p in sys.path]
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(path))
+
+    return subprocess.check_output([sys.executable, '-c', code], env=env,
+                                   universal_newlines=True)
@@ -0,0 +1,382 @@
+'''
+Author: Dan Valente
+
+Runs the benchmarks and keeps their results, one JSON file per commit,
+so that regressions between commits can be found.
+
+The benchmark classes follow the conventions of asv (airspeed
+velocity), so they can also be run by asv.  This runner needs nothing
+beyond numpy: time_* methods are timed with timeit (the median and
+minimum time per call over several repeats are kept), and peakmem_*
+methods are run under tracemalloc, which records the peak memory
+allocated by Python and numpy during the call (memory allocated
+internally by FFT libraries is not seen).  timeraw_* methods return
+code, which is timed in a new interpreter each repeat, and track_*
+methods return the value to record.  Caches (tapers, kernels,
+filter banks) are warmed by a first untimed call, so times are for
+steady state use.
+
+For every time_* benchmark with a 'seconds' parameter, the slope of
+log(time) against log(seconds) is reported for each setting of the
+other parameters: about 1 for linear scaling in the signal length.
+
+From the command line:
+
+    python -m pythagoras.benchmarks.runner                  # run all
+    python -m pythagoras.benchmarks.runner -b STFT --quick  # a subset
+    python -m pythagoras.benchmarks.runner --compare results/abc1234.json \
+        results/def5678.json
+'''
+
+import argparse
+import datetime
+import importlib
+import itertools
+import json
+import os
+import platform
+import re
+import subprocess
+import sys
+import timeit
+import tracemalloc
+
+import numpy as np
+from pythagoras.benchmarks.common import python
+
+_modules = ['bench_transforms', 'bench_filter_banks', 'bench_separate',
+            'bench_import']
+_kinds = ('time_', 'timeraw_', 'peakmem_', 'track_')
+_here = os.path.dirname(os.path.abspath(__file__))
+
+
+def run(pattern=None, quick=False, progress=True):
+    """
+        run(pattern=None, quick=False, progress=True)
+            Runs the benchmarks.
+
+        Input
+        -----
+            pattern:    regular expression; only benchmarks whose name
+                        (e.g. 'bench_transforms.STFT.time_stft') it
+                        matches are run
+            quick:      if True, each benchmark is timed with fewer and
+                        shorter repeats
+            progress:   if True, prints each result to stderr
+
+        Returns
+        -------
+            dict of results, as saved by save()
+    """
+
+    repeat, min_time = (3, 0.05) if quick else (7, 0.2)
+
+    results = {}
+    for bench_name, cls, method in _benchmarks(pattern):
+        params = getattr(cls, 'params', [])
+        names = getattr(cls, 'param_names', [])
+        values = []
+        for combo in itertools.product(*params):
+            record = _run_one(cls, method, combo, repeat, min_time)
+            record['params'] = dict(zip(names, combo))
+            values.append(record)
+            if progress:
+                _print_record(bench_name, record, _unit(cls, method))
+
+        result = {'unit': _unit(cls, method),
+                  'param_names': list(names),
+                  'values': values}
+        if method.startswith('time_') and 'seconds' in names:
+            result['scaling'] = _scaling(values)
+        results[bench_name] = result
+
+    return {'commit': _commit(),
+            'date': datetime.datetime.now().isoformat(timespec='seconds'),
+            'machine': {'python': platform.python_version(),
+                        'numpy': np.__version__,
+                        'platform': platform.platform(),
+                        'processor': platform.processor(),
+                        'cpus': os.cpu_count()},
+            'quick': quick,
+            'results': results}
+
+
+def save(results, out_dir=None):
+    """
+        save(results, out_dir=None)
+            Writes the results of run() to <out_dir>/<commit>.json.
+            out_dir defaults to the results directory next to this file.
+            If the file exists (e.g. from running other benchmarks on
+            the same commit), the new results are merged into it.
+
+        Returns
+        -------
+            the name of the file written
+    """
+
+    if out_dir is None:
+        out_dir = os.path.join(_here, 'results')
+
+    os.makedirs(out_dir, exist_ok=True)
+    filename = os.path.join(out_dir, results['commit'] + '.json')
+    if os.path.exists(filename):
+        merged = _load(filename)['results']
+        merged.update(results['results'])
+        results = dict(results, results=merged)
+
+    with open(filename, 'w') as f:
+        json.dump(results, f, indent=1, sort_keys=True)
+
+    return filename
+
+
+def compare(old, new, factor=1.1):
+    """
+        compare(old, new, factor=1.1)
+            Compares two sets of results (from run(), or the names of
+            files written by save()).
+
+        Input
+        -----
+            old, new:   the results to compare
+            factor:     ratio of new to old above which a result is
+                        flagged as a regression (and below 1/factor, as
+                        an improvement)
+
+        Returns
+        -------
+            list of (benchmark name, params, old value, new value,
+            ratio) tuples, for every result present in both, largest
+            ratio first
+    """
+
+    old, new = _load(old), _load(new)
+
+    rows = []
+    for name, result in new['results'].items():
+        if name not in old['results']:
+            continue
+        before = dict((_key(v['params']), v['value'])
+                      for v in old['results'][name]['values'])
+        for v in result['values']:
+            key = _key(v['params'])
+            if before.get(key) is None or v['value'] is None:
+                continue
+            if before[key]:
+                ratio = v['value'] / float(before[key])
+            else:
+                # e.g. a track_ count that was 0
+                ratio = float('inf') if v['value'] else 1.
+            rows.append((name, v['params'], before[key], v['value'], ratio))
+
+    rows.sort(key=lambda row: -row[4])
+
+    return rows
+
+
+def _benchmarks(pattern):
+    # (name, class, method name) of every benchmark matching pattern
+
+    found = []
+    for module_name in _modules:
+        module = importlib.import_module('pythagoras.benchmarks.'
+                                         + module_name)
+        for cls_name, cls in sorted(vars(module).items()):
+            if not isinstance(cls, type) or cls.__module__ != module.__name__:
+                continue
+            for method in sorted(vars(cls)):
+                if not method.startswith(_kinds):
+                    continue
+                name = '%s.%s.%s' % (module_name, cls_name, method)
+                if pattern is None or re.search(pattern, name):
+                    found.append((name, cls, method))
+
+    return found
+
+
+def _run_one(cls, method, combo, repeat, min_time):
+    # Runs one benchmark for one combination of params
+
+    bench = cls()
+    try:
+        if hasattr(bench, 'setup'):
+            bench.setup(*combo)
+    except NotImplementedError:
+        return {'value': None, 'skipped': True}
+
+    func = getattr(bench, method)
+
+    record = {}
+    if method.startswith('timeraw_'):
+        code = func(*combo)
+        script = ('import time\nt = time.perf_counter()\n'
+                  'exec(compile(%r, "<timeraw>", "exec"))\n'
+                  'print(time.perf_counter() - t)' % code)
+        times = [float(python(script)) for i in range(repeat)]
+        record['value'] = float(np.median(times))
+        record['min'] = float(np.min(times))
+    elif method.startswith('track_'):
+        record['value'] = func(*combo)
+    elif method.startswith('time_'):
+        func(*combo)
+        timer = timeit.Timer(lambda: func(*combo))
+        number = 1
+        while True:
+            if timer.timeit(number) >= min_time / repeat or number >= 2**20:
+                break
+            number *= 4
+        times = np.array(timer.repeat(repeat, number)) / number
+        record['value'] = float(np.median(times))
+        record['min'] = float(np.min(times))
+        n_samples = getattr(bench, 'n_samples', None)
+        if n_samples:
+            record['throughput'] = n_samples / record['value']
+    else:
+        func(*combo)
+        tracemalloc.start()
+        try:
+            base = tracemalloc.get_traced_memory()[0]
+            func(*combo)
+            record['value'] = tracemalloc.get_traced_memory()[1] - base
+        finally:
+            tracemalloc.stop()
+
+    if hasattr(bench, 'teardown'):
+        bench.teardown(*combo)
+
+    return record
+
+
+def _unit(cls, method):
+    if method.startswith(('time_', 'timeraw_')):
+        return 'seconds'
+    if method.startswith('peakmem_'):
+        return 'bytes'
+
+    return getattr(getattr(cls, method), 'unit', 'unit')
+
+
+def _scaling(values):
+    # Slope of log(time) against log(seconds), for each setting of the
+    # other params
+
+    groups = {}
+    for v in values:
+        if v['value'] is None:
+            continue
+        others = dict((k, p) for k, p in v['params'].items()
+                      if k != 'seconds')
+        groups.setdefault(_key(others), (others, []))[1].append(
+            (v['params']['seconds'], v['value']))
+
+    slopes = []
+    for others, points in groups.values():
+        if len(points) < 2:
+            continue
+        n, t = np.log(np.array(points, dtype=float)).T
+        slopes.append({'params': others,
+                       'exponent': float(np.polyfit(n, t, 1)[0])})
+
+    return slopes
+
+
+def _commit():
+    # Short hash of the checked out commit, marked if there are
+    # uncommitted changes
+
+    def git(*args):
+        return subprocess.check_output(('git', '-C', _here) + args,
+                                       stderr=subprocess.DEVNULL,
+                                       universal_newlines=True).strip()
+
+    try:
+        commit = git('rev-parse', '--short', 'HEAD')
+        if git('status', '--porcelain', '--untracked-files=no'):
+            commit += '-dirty'
+    except (OSError, subprocess.CalledProcessError):
+        commit = 'unknown'
+
+    return commit
+
+
+def _load(results):
+    if isinstance(results, str):
+        with open(results) as f:
+            return json.load(f)
+
+    return results
+
+
+def _key(params):
+    return tuple(sorted((k, str(v)) for k, v in params.items()))
+
+
+def _format(value, unit):
+    if value is None:
+        return 'skipped'
+    if unit == 'bytes':
+        return '%.1f MB' % (value / 2.**20)
+    if unit != 'seconds':
+        return '%s %s' % (value, unit)
+    if value < 1e-3:
+        return '%.1f us' % (value * 1e6)
+    if value < 1:
+        return '%.2f ms' % (value * 1e3)
+
+    return '%.2f s' % value
+
+
+def _print_record(name, record, unit):
+    params = ', '.join('%s=%s' % item for item in record['params'].items())
+    line = '%s(%s): %s' % (name, params, _format(record['value'], unit))
+    if 'throughput' in record:
+        line += ' (%.3g samples/s)' % record['throughput']
+    sys.stderr.write(line + '\n')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='python -m pythagoras.benchmarks.runner',
+        description='Run the benchmarks, or compare two sets of results.')
+    parser.add_argument('-b', '--bench', default=None,
+                        help='only run benchmarks matching this regex')
+    parser.add_argument('--quick', action='store_true',
+                        help='fewer, shorter repeats')
+    parser.add_argument('-o', '--out-dir', default=None,
+                        help='directory to save results to')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'),
+                        help='compare two results files instead of running')
+    parser.add_argument('--factor', type=float, default=1.1,
+                        help='ratio flagged as a regression by --compare')
+    args = parser.parse_args(argv)
+
+    if args.compare:
+        rows = compare(args.compare[0], args.compare[1], args.factor)
+        regressed = 0
+        for name, params, before, after, ratio in rows:
+            if ratio > args.factor:
+                flag = 'REGRESSION'
+                regressed += 1
+            elif ratio < 1. / args.factor:
+                flag = 'improved'
+            else:
+                flag = ''
+            params = ', '.join('%s=%s' % item for item in params.items())
+            print('%6.2fx %-10s %s(%s)' % (ratio, flag, name, params))
+
+        return 1 if regressed else 0
+
+    results = run(args.bench, args.quick)
+    for name, result in sorted(results['results'].items()):
+        for slope in result.get('scaling', []):
+            params = ', '.join('%s=%s' % item
+                               for item in slope['params'].items())
+            print('%s(%s): time ~ seconds**%.2f'
+                  % (name, params, slope['exponent']))
+    print('Saved %s' % save(results, args.out_dir))
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,4 +1,4 @@
 from .constq import constq
-from .mel import mel
+from .mel import mel, apply_mel
 
-__all__ = ['constq', 'mel']
+__all__ = ['constq', 'mel', 'apply_mel']
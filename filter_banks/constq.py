@@ -1,14 +1,18 @@
 # Author: Dan Valente
 
+from functools import lru_cache
+
 import numpy as np
-from pythagoras.utils import utils
-from scipy import fft
+from pythagoras.utils import utils, fft_backend, instrument
 
 
-def constq(fmin=100, Q=17, n=12, fs=44100, nfft=1024, taper_name='hamming'):
+def constq(fmin=100, Q=17, n=12, fs=44100, nfft=1024, taper_name='hamming',
+           one_sided=False, sparse=False, threshold=0.0054, nbins=None,
+           dtype=None):
     """
         constq(fmin=100, Q=17, n=12, fs=44100, nfft=1024,
-               taper_name='hamming')
+               taper_name='hamming', one_sided=False, sparse=False,
+               threshold=0.0054, nbins=None, dtype=None)
             Calculates the filter bank (spectral kernel) for the
             Constant-Q Transform according to the method given in
             Brown & Puckette (1992).  Filter center frequencies range
@@ -25,37 +29,101 @@ def constq(fmin=100, Q=17, n=12, fs=44100, nfft=1024, taper_name='hamming'):
                 nfft:        number of points in the fft of the
                              temporal kernels
                 taper_name:  the name of the taper to use for the kernel
+                one_sided:   if True, only the nfft/2+1 non-negative
+                             frequency columns of the kernel are
+                             returned, to match a one-sided spectrum
+                             from tfft or stft.
+                sparse:      if True, kernel values with magnitude
+                             below threshold are dropped and the kernel
+                             is returned as a scipy.sparse CSR matrix,
+                             as suggested by Brown & Puckette.  For
+                             large nfft this is orders of magnitude
+                             smaller than the dense kernel.
+                threshold:   the magnitude threshold for sparse kernels
+                nbins:       if given, only the first nbins filters
+                             (starting at fmin) are returned, e.g.
+                             nbins=n for a single octave.  Filters above
+                             fs/2 are never returned.
+                dtype:       float dtype of the transform the kernel is
+                             for, e.g. np.float32 for a complex64
+                             kernel.  The kernel is always computed in
+                             double precision.  Default is float64.
 
             Returns
             -------
-                spectral kernel [2D np.array, size (Nq,nfft)]
+                spectral kernel [2D np.array, size (Nq,nfft), or
+                    (Nq,nfft/2+1) if one_sided; a CSR matrix if sparse]
                     where Nq is the number of frequency bins in the
                     Q transform
 
+            Kernels are cached on their arguments, so repeated calls
+            (e.g. from cqt) return the same, read-only, object. Copy it
+            before modifying it.
+
        [REF]
        Brown JC and Puckette MS (1992). An efficient algorithm for the
        calculation of a constant Q transform. J. Acoust. Soc. Am.
        92(5):2698-2701
 
     """
-    #Number of components should only go up to the Nyquist frequency.
-    #This is a function of fmin, as well as fs
-    fk = []
-    i = f = 0
-    while (f <= fs/2):
-        #Logarithmic spacing of frequencies.
-        f = ((2 ** (1.0 / n)) ** i) * fmin
-        fk.append(f)
-        i += 1
-        fk = np.array(fk)
+    return _constq(fmin, Q, n, fs, nfft, taper_name, one_sided,
+                   sparse, threshold if sparse else None, nbins,
+                   np.result_type(dtype, np.complex64))
+
+
+@lru_cache(maxsize=16)
+@instrument.timed('constq')
+def _constq(fmin, Q, n, fs, nfft, taper_name, one_sided, sparse, threshold,
+            nbins, dtype):
+
+    Nq = _n_bins(fmin, n, fs)
+    if nbins is not None:
+        Nq = min(Nq, nbins)
+
+    #Logarithmic spacing of frequencies.
+    fk = fmin * 2 ** (np.arange(Nq) / float(n))
 
     #Length of taper is frequency dependent
-    N = (fs / fk) * Q
+    N = np.round((fs / fk) * Q).astype(int)
+
+    # The kernels are analytic (positive frequency only), so little is
+    # lost by dropping the negative frequency half when one_sided.
+    ncols = nfft//2 + 1 if one_sided else nfft
+
+    if sparse:
+        # Threshold one row at a time, so the dense kernel is never
+        # held in memory.
+        data, indices, indptr = [], [], [0]
+    else:
+        kernel = np.zeros((len(fk), ncols), dtype=dtype)
 
-    kernel = np.zeros((len(fk), nfft), dtype='complex')
     for k in range(len(fk)):
         tap = utils.get_taper(taper_name, N[k])
-        kstar = tap * np.exp(-1j * 2 * np.pi * Q * np.arange(N[k]) / N[k])
-        kernel[k, :] = np.conj(fft(np.conj(kstar), nfft)) / N[k]
+        kstar = tap * np.exp(-1j * 2 * np.pi * fk[k] / fs * np.arange(N[k]))
+        row = np.conj(fft_backend.fft(np.conj(kstar), nfft)[:ncols]) / N[k]
+        if sparse:
+            keep = np.flatnonzero(np.abs(row) >= threshold)
+            data.append(row[keep])
+            indices.append(keep)
+            indptr.append(indptr[-1] + len(keep))
+        else:
+            kernel[k, :] = row
+
+    if sparse:
+        from scipy import sparse as sp
+        kernel = sp.csr_matrix((np.concatenate(data).astype(dtype),
+                                np.concatenate(indices), indptr),
+                               shape=(len(fk), ncols))
+        for a in (kernel.data, kernel.indices, kernel.indptr):
+            a.setflags(write=False)
+    else:
+        kernel.setflags(write=False)
 
     return kernel
+
+
+def _n_bins(fmin, n, fs):
+    # Number of components should only go up to the Nyquist frequency.
+    # This is a function of fmin, as well as fs. The small tolerance
+    # keeps a bin that lands on fs/2 from being lost to rounding.
+    return int(np.floor(n * np.log2(fs / 2. / fmin) + 1e-9)) + 1
@@ -1,13 +1,15 @@
 # Author: Dan Valente
 
+from functools import lru_cache
+
 import numpy as np
-from pythagoras.utils import utils
-from scipy import fft
+from pythagoras.utils import utils, instrument
 
 
-def mel(fstart=0, fs=44100, nfilt=40, nfft=8192):
+def mel(fstart=0, fs=44100, nfilt=40, nfft=8192, sparse=False, dtype=None):
     """
-        mel(fstart=0,fs=44100,nfilt=40,nfft=8192)
+        mel(fstart=0,fs=44100,nfilt=40,nfft=8192,sparse=False,
+            dtype=None)
             Creates the filter bank used for mapping frequency-domain
              energy in the STFT to the mel domain
 
@@ -19,11 +21,21 @@ def mel(fstart=0, fs=44100, nfilt=40, nfft=8192):
             nfft:      the number of points used to calculate the STFT.
                         Make sure this matches with the number of points
                         in the STFT that you'll be filtering.
+            sparse:    if True, the filter bank is returned as a
+                        scipy.sparse CSC matrix, which stores only the
+                        non-zero bins of each filter.  Use apply_mel to
+                        apply either form.
+            dtype:     float dtype of the filter bank, e.g. np.float32.
+                        Default is float64.
 
         Returns
         -------
             Filter bank [2D np.array, size (nfft/2+1,nfilt)]
 
+            Filter banks are cached on their arguments, so repeated
+            calls return the same, read-only, object.  Copy it before
+            modifying it.
+
         Note:
             There are numerous implementations of the mel-frequency
             filter bank. For a summary see [3]. In light of this, I have
@@ -43,7 +55,14 @@ def mel(fstart=0, fs=44100, nfilt=40, nfft=8192):
             verification task." In Proceedings of the SPECOM, vol. 1,
             pp. 191-194. 2005.
     """
-    
+
+    return _mel(fstart, fs, nfilt, nfft, sparse, np.dtype(dtype))
+
+
+@lru_cache(maxsize=16)
+@instrument.timed('mel')
+def _mel(fstart, fs, nfilt, nfft, sparse, dtype):
+
     # Get vector of center frequencies
     m_start, m_end = utils.freq2mel(np.array([fstart, fs/2]))
     mc = np.linspace(m_start, m_end, nfilt + 2)  # +2 for the proper endpoints
@@ -61,14 +80,74 @@ def mel(fstart=0, fs=44100, nfilt=40, nfft=8192):
     # cbin = np.floor((nfft+1)*fc/fs))  [2] method.
     cbin = np.round(fc*nfft/fs)  # [1] method
 
-    #Create filter bank matrix (carefully, since Python indexes from 0)
-    #Size only goes up to Nyquist.
-    fbank = np.zeros((nfft/2 + 1, nfilt))
-    for k in range(1, nfilt + 1):
-        for i in range(np.round(nfft/2 + 1) + 1):
-            if (i >= cbin[k-1] and i <= cbin[k]):
-                fbank[i, k-1] = (i - cbin[k-1]) / (cbin[k]-cbin[k-1])
-            elif (i >= cbin[k] and i <= cbin[k+1]):
-                fbank[i, k-1] = 1-(i-cbin[k])/(cbin[k+1]-cbin[k])
+    #Create filter bank matrix. Size only goes up to Nyquist.
+    #Bin i of filter k rises from the lower edge c0 to the center c1,
+    #then falls to the upper edge c2.
+    c0, c1, c2 = cbin[:-2], cbin[1:-1], cbin[2:]
+
+    if sparse:
+        fbank = _mel_sparse(c0, c1, c2, nfft//2 + 1, dtype)
+        for a in (fbank.data, fbank.indices, fbank.indptr):
+            a.setflags(write=False)
+        return fbank
+
+    i = np.arange(nfft//2 + 1)[:, np.newaxis]
+    rising = (i >= c0) & (i <= c1)
+    falling = ~rising & (i >= c1) & (i <= c2)
+
+    #Coincident edges (small nfft) divide by zero, as they always have
+    with np.errstate(divide='ignore', invalid='ignore'):
+        fbank = np.where(rising, (i - c0) / (c1 - c0),
+                         np.where(falling, 1 - (i - c1) / (c2 - c1), 0.))
+    fbank = fbank.astype(dtype, copy=False)
+    fbank.setflags(write=False)
 
     return fbank
+
+
+def apply_mel(fbank, S):
+    """
+        apply_mel(fbank, S)
+            Applies a mel filter bank to a one-sided spectrum or
+            spectrogram.  If fbank is sparse (mel(sparse=True)) only the
+            non-zero bins of each filter are touched.
+
+        Input
+        -----
+            fbank:     filter bank from mel, size (nfft/2+1, nfilt)
+            S:         one-sided magnitude spectrum, size (nfft/2+1,)
+                        or (nfft/2+1, n_frames), or a stack of
+                        spectrograms (..., nfft/2+1, n_frames)
+
+        Returns
+        -------
+            Filtered spectrum [np.array, size (nfilt,) or
+                               (..., nfilt, n_frames)]
+    """
+
+    return utils._bank_product(fbank.T, S)
+
+
+def _mel_sparse(c0, c1, c2, n_bins, dtype):
+    # The filter bank as a CSC matrix, built from the bin range
+    # [c0, c2] of each filter alone, with the same values (and the same
+    # zeros left out) as the dense bank
+
+    from scipy import sparse as sp
+
+    data, indices = [], []
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for lo, mid, hi in zip(c0, c1, c2):
+            i = np.arange(lo, min(hi, n_bins - 1) + 1)
+            v = np.where(i <= mid, (i - lo) / (mid - lo),
+                         1 - (i - mid) / (hi - mid))
+            keep = v != 0
+            data.append(v[keep])
+            indices.append(i[keep].astype(np.int32))
+
+    indptr = np.zeros(len(data) + 1, dtype=np.int32)
+    indptr[1:] = np.cumsum([len(d) for d in data])
+
+    return sp.csc_matrix((np.concatenate(data).astype(dtype, copy=False),
+                          np.concatenate(indices), indptr),
+                         shape=(n_bins, len(data)))
@@ -1,3 +1,5 @@
 from .nmf import nmf
+from .online import OnlineNMF
+from .pipeline import separate
 
-__all__ = ['nmf']
+__all__ = ['nmf', 'OnlineNMF', 'separate']
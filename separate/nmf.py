@@ -1,50 +1,311 @@
 # Author: Dan Valente
 
-import nimfa
-from sklearn.decomposition import NMF
+import numpy as np
+
+# Smallest value allowed in the factors and in denominators, as in sklearn
+_EPS = np.finfo(np.float32).eps
+
+_betas = {'euclidean': 2., 'frobenius': 2., 'kullback-leibler': 1.,
+          'itakura-saito': 0.}
 
 
 def nmf(X, method='sklearn', **nmfparams):
     """
-    Calculates the non-negative matrix factorization of an input matrix
+        nmf(X, method='sklearn', **nmfparams)
+            Calculates the non-negative matrix factorization X ~ W H
+            of an input matrix, e.g. a magnitude spectrogram.
+
+        Input
+        -----
+            X:             non-negative matrix, size (n_freq, n_frames).
+                           With the native methods, a stack of matrices
+                           of the same size (n_batch, n_freq, n_frames)
+                           is factorized in one call.
+            method:        'mu' (multiplicative updates) or 'hals'
+                           (hierarchical alternating least squares),
+                           which are native; or 'sklearn' or 'nimfa',
+                           which pass nmfparams on to those packages.
+            nmfparams:     for the native methods:
+                n_components:  number of components K. Defaults to the
+                               number of columns of basis if given.
+                beta:          the beta-divergence minimized: 2 or
+                               'euclidean', 1 or 'kullback-leibler', 0 or
+                               'itakura-saito' (or any number, for 'mu').
+                               'hals' only minimizes the euclidean
+                               distance.  Default is 2.
+                max_iter:      maximum number of iterations (200)
+                tol:           stop when the divergence, checked every
+                               10 iterations, falls by less than this
+                               fraction (1e-4).  0 runs max_iter
+                               iterations.
+                basis:         initial W, size (n_freq, K), or
+                               (n_batch, n_freq, K) for a batch (e.g. a
+                               previous result, as a warm start)
+                activations:   initial H, size (K, n_frames), or
+                               (n_batch, K, n_frames)
+                fix_basis:     if True, only H is updated and basis
+                               (which is required) is kept, e.g. to
+                               separate with a learned dictionary.  A
+                               2D basis is then shared by the batch.
+                random_state:  seed for the random initial W and H
+                               that are not given
+
+        Returns
+        -------
+        (W, H, model)
+            W:       the basis (spectral templates), size (n_freq, K),
+                     or (n_batch, n_freq, K) for a batch unless the
+                     basis was fixed and shared
+            H:       the activations, size (K, n_frames) or
+                     (n_batch, K, n_frames)
+            model:   for the native methods, a dict of 'method', 'beta',
+                     'n_iter', 'divergence' (the final divergence summed
+                     over the batch) and 'converged'; otherwise the
+                     sklearn or nimfa model
+
+        [REF]
+        Fevotte C and Idier J (2011). Algorithms for nonnegative matrix
+        factorization with the beta-divergence. Neural Computation
+        23(9):2421-2456
+
+        Cichocki A and Phan AH (2009). Fast local algorithms for large
+        scale nonnegative matrix and tensor factorizations. IEICE
+        Trans. Fundamentals E92-A(3):708-721
     """
 
-    #TODO: Documentation
+    if method in ('mu', 'hals'):
+        return _nmf_native(X, method, **nmfparams)
 
+    # The solvers are imported on first use, as both are slow to import
     if method == 'sklearn':
+        from sklearn.decomposition import NMF
         model = NMF(**nmfparams)
         H = model.fit_transform(X)
         W = model.components_
     elif method == 'nimfa':
+        import nimfa
         model_tmp = nimfa.mf(X, **nmfparams)
         model = nimfa.mf_run(model_tmp)
         H = model.coef()
         W = model.basis()
+    else:
+        raise ValueError("Unknown NMF method '%s'. Choices are: mu, hals, "
+                         "sklearn, nimfa" % method)
 
     return (H, W, model)
 
-if __name__ == "__main__":
-
-    # Test NMF
-    import scipy.io.wavfile as wv
-    from pythagoras.transforms import stft
-    import matplotlib.pyplot as plt
-    import time
-    import sys
-    
-    main_dir = sys.argv[1]
-    data_dir = main_dir + "/data/"
-    filename = "dylan_original.wav"
-
-    (fs, dylan) = wv.read(data_dir + filename)
-    dylan10 = dylan[:fs*10]
-    (S, freq, t) = stft(dylan10, frame_size=2000, step_size=250, nfft=8192)
-
-    sklearn_start = time.clock()
-    #(sep_spect, sep_time, nmf_model) = nmf(abs(S), method='sklearn',
-    #                                       n_components=2)
-    (sep_spect, sep_time, nmf_model) = nmf(abs(S), method='nimfa',
-                                           rank=2)
-    sklearn_stop = time.clock()
-
-    print sklearn_stop-sklearn_start
+
+def _nmf_native(X, method, n_components=None, beta=2, max_iter=200, tol=1e-4,
+                basis=None, activations=None, fix_basis=False,
+                random_state=None):
+
+    # The products with V are much faster on C ordered data (a
+    # spectrogram from stft is not)
+    V = np.ascontiguousarray(X)
+    if not np.issubdtype(V.dtype, np.floating):
+        V = V.astype(float)
+    if V.ndim not in (2, 3):
+        raise ValueError("X must be 2D, or 3D for a batch")
+    if V.min() < 0:
+        raise ValueError("X must be non-negative")
+
+    beta = float(_betas.get(beta, beta))
+    if method == 'hals' and beta != 2:
+        raise ValueError("hals only supports the euclidean distance "
+                         "(beta=2)")
+
+    if fix_basis and basis is None:
+        raise ValueError("fix_basis requires a basis")
+
+    if n_components is None:
+        if basis is None:
+            raise ValueError("n_components or basis must be given")
+        n_components = np.shape(basis)[-1]
+
+    W, H = _init(V, n_components, basis, activations, fix_basis,
+                 random_state)
+
+    if beta <= 0:
+        # The divergence is not defined for zeros in X
+        V = np.maximum(V, _EPS)
+
+    # Multiplicative updates for beta < 1 need an exponent to be sure
+    # to decrease the divergence (Fevotte & Idier 2011)
+    gamma = 1. / (2 - beta) if beta < 1 else 1.
+
+    if method == 'mu':
+        update = _mu
+    else:
+        update = _hals
+
+    # Products that only depend on W are kept while W is fixed
+    fixed = {}
+
+    error = _divergence(V, W, H, beta)
+    converged = False
+    n_iter = 0
+    for n_iter in range(1, max_iter + 1):
+        W, H = update(V, W, H, beta, gamma, fix_basis, fixed)
+
+        if tol > 0 and n_iter % 10 == 0:
+            previous, error = error, _divergence(V, W, H, beta)
+            if previous - error <= tol * previous:
+                converged = True
+                break
+
+    if not converged:
+        error = _divergence(V, W, H, beta)
+
+    model = {'method': method, 'beta': beta, 'n_iter': n_iter,
+             'divergence': error, 'converged': converged}
+
+    return W, H, model
+
+
+def _init(V, K, basis, activations, fix_basis, random_state):
+    # Initial factors, from basis and activations where given and
+    # otherwise random, scaled so that W H has the mean of V
+
+    dtype = V.dtype
+    F, T = V.shape[-2:]
+    lead = V.shape[:-2]
+    rng = np.random.RandomState(random_state)
+    scale = np.sqrt(V.mean() / K)
+
+    if basis is None:
+        W = scale * rng.rand(*lead + (F, K))
+    else:
+        W = np.array(basis, dtype=dtype)
+        if not fix_basis and W.ndim < V.ndim:
+            # Each matrix of the batch gets its own copy to update
+            W = np.broadcast_to(W, lead + W.shape).copy()
+
+    if activations is None:
+        H = scale * rng.rand(*lead + (K, T))
+    else:
+        H = np.broadcast_to(activations, lead + (K, T)).copy()
+
+    W = np.maximum(W.astype(dtype, copy=False), 0)
+    H = np.maximum(H.astype(dtype, copy=False), _EPS)
+
+    if W.shape[-2:] != (F, K) or W.ndim > V.ndim:
+        raise ValueError("basis has shape %s, but (%d, %d) is needed"
+                         % (W.shape, F, K))
+
+    return W, H
+
+
+def _T(A):
+    # Transpose of the last two axes
+    return np.swapaxes(A, -1, -2)
+
+
+def _mu(V, W, H, beta, gamma, fix_basis, fixed):
+    # One multiplicative update of H, then of W unless it is fixed
+
+    Wt = _T(W)
+    if beta == 2:
+        if 'WtV' in fixed:
+            WtV, WtW = fixed['WtV'], fixed['WtW']
+        else:
+            WtV, WtW = Wt @ V, Wt @ W
+            if fix_basis:
+                fixed['WtV'], fixed['WtW'] = WtV, WtW
+        num, den = WtV, WtW @ H
+    elif beta == 1:
+        num = Wt @ (V / _product(W, H))
+        den = W.sum(axis=-2)[..., np.newaxis]
+    else:
+        WH = _product(W, H)
+        num = Wt @ (V * WH ** (beta - 2))
+        den = Wt @ WH ** (beta - 1)
+
+    H = H * _ratio(num, den, gamma)
+
+    if fix_basis:
+        return W, H
+
+    Ht = _T(H)
+    if beta == 2:
+        num, den = V @ Ht, W @ (H @ Ht)
+    elif beta == 1:
+        num = (V / _product(W, H)) @ Ht
+        den = H.sum(axis=-1)[..., np.newaxis, :]
+    else:
+        WH = _product(W, H)
+        num = (V * WH ** (beta - 2)) @ Ht
+        den = WH ** (beta - 1) @ Ht
+
+    W = W * _ratio(num, den, gamma)
+
+    return W, H
+
+
+def _product(W, H):
+    # W H, clipped away from zero in place
+    WH = W @ H
+    np.maximum(WH, _EPS, out=WH)
+
+    return WH
+
+
+def _ratio(num, den, gamma):
+    ratio = num / np.maximum(den, _EPS)
+    if gamma != 1:
+        ratio **= gamma
+
+    return ratio
+
+
+def _hals(V, W, H, beta, gamma, fix_basis, fixed):
+    # One sweep of HALS over the rows of H, then the columns of W unless
+    # it is fixed.  Each row (column) is the exact least squares update
+    # with the others held, clipped at zero.
+
+    if 'WtV' in fixed:
+        WtV, WtW = fixed['WtV'], fixed['WtW']
+    else:
+        WtV, WtW = _T(W) @ V, _T(W) @ W
+        if fix_basis:
+            fixed['WtV'], fixed['WtW'] = WtV, WtW
+
+    H = H.copy()
+    for k in range(H.shape[-2]):
+        step = (WtV[..., k, :] - (WtW[..., k:k + 1, :] @ H)[..., 0, :])
+        H[..., k, :] = np.maximum(H[..., k, :]
+                                  + step / np.maximum(WtW[..., k, k:k + 1],
+                                                      _EPS),
+                                  _EPS)
+
+    if fix_basis:
+        return W, H
+
+    VHt, HHt = V @ _T(H), H @ _T(H)
+    W = W.copy()
+    for k in range(W.shape[-1]):
+        step = VHt[..., :, k] - (W @ HHt[..., :, k:k + 1])[..., 0]
+        W[..., :, k] = np.maximum(W[..., :, k]
+                                  + step / np.maximum(HHt[..., k, k:k + 1],
+                                                      _EPS),
+                                  0)
+
+    return W, H
+
+
+def _divergence(V, W, H, beta):
+    # The beta-divergence of W H from V, summed over the batch
+
+    WH = _product(W, H)
+    if beta == 2:
+        return 0.5 * float(np.sum((V - WH) ** 2))
+    if beta == 1:
+        nz = V > 0
+        return float(np.sum(V[nz] * np.log(V[nz] / WH[nz]))
+                     - np.sum(V) + np.sum(WH))
+    if beta == 0:
+        ratio = V / WH
+        return float(np.sum(ratio - np.log(ratio)) - ratio.size)
+
+    return float(np.sum(V ** beta + (beta - 1) * WH ** beta
+                        - beta * V * WH ** (beta - 1))
+                 / (beta * (beta - 1)))
@@ -0,0 +1,214 @@
+# Author: Dan Valente
+
+import numpy as np
+from pythagoras.separate.nmf import (nmf, _betas, _product, _ratio, _T,
+                                     _EPS)
+
+
+class OnlineNMF(object):
+    """
+        OnlineNMF(n_components, beta=2, h_iter=10, passes=4, forget=1.,
+                  basis=None, random_state=None)
+            NMF of a stream of spectrogram frames that arrive in
+            minibatches, e.g. from StreamSTFT.  Each call to
+            partial_fit() alternates a few times between finding the
+            activations H of the new frames with the basis W held, and
+            updating W from running statistics (the size of W) of all
+            the frames seen.  The columns of W are kept at unit sum.
+            Memory use is bounded by one minibatch plus the statistics,
+            whatever the length of the stream, so a long recording can
+            be factorized in a single pass.
+
+        Input
+        -----
+            n_components:  number of components K
+            beta:          the beta-divergence minimized. See nmf.
+            h_iter:        multiplicative updates of H per pass
+            passes:        alternations of H and W per minibatch
+            forget:        factor (at most 1) the past statistics are
+                           scaled by before each minibatch is added.
+                           Below 1, the basis follows changes in the
+                           signal and old frames are gradually
+                           forgotten.
+            basis:         initial W, size (n_freq, K).  Default is
+                           random, scaled to the first minibatch.
+            random_state:  seed for the random initial W
+
+        Example
+        -------
+            analyzer = StreamSTFT(frame_size=2048, step_size=512,
+                                  one_sided=True)
+            model = OnlineNMF(n_components=8, beta=1)
+            for chunk in chunks:
+                H = model.partial_fit(np.abs(analyzer.process(chunk)))
+            W = model.basis
+
+        [REF]
+        Lefevre A, Bach F and Fevotte C (2011). Online algorithms for
+        nonnegative matrix factorization with the Itakura-Saito
+        divergence. IEEE WASPAA, 313-316
+    """
+
+    def __init__(self, n_components, beta=2, h_iter=10, passes=4,
+                 forget=1., basis=None, random_state=None):
+
+        if not 0 < forget <= 1:
+            raise ValueError("forget must be in (0, 1]")
+
+        self.n_components = n_components
+        self.beta = float(_betas.get(beta, beta))
+        self._gamma = 1. / (2 - self.beta) if self.beta < 1 else 1.
+        self.h_iter = h_iter
+        self.passes = passes
+        self.forget = forget
+        self.random_state = random_state
+        self._initial_basis = basis
+        self.reset()
+
+    def reset(self):
+        """
+            reset()
+                Discards the statistics and returns to the initial
+                basis, to start a new stream.
+        """
+        if self._initial_basis is None:
+            self.basis = None
+        else:
+            self.basis = np.array(self._initial_basis, dtype=float)
+        self._num = None
+        self._den = None
+        self.n_frames = 0
+        self.n_batches = 0
+
+    def partial_fit(self, X):
+        """
+            partial_fit(X)
+                Adds a minibatch of frames to the factorization.
+
+            Input
+            -----
+                X:    non-negative frames, e.g. a magnitude
+                      spectrogram, size (n_freq, n_frames)
+
+            Returns
+            -------
+                H:    activations of the frames, size (K, n_frames)
+        """
+
+        X = self._frames(X)
+        if self.basis is None:
+            rng = np.random.RandomState(self.random_state)
+            scale = np.sqrt(X.mean() / self.n_components)
+            self.basis = scale * rng.rand(X.shape[0], self.n_components)
+
+        if self._num is not None:
+            self._num = self.forget * self._num
+            self._den = self.forget * self._den
+
+        # Alternate between H and W on the minibatch, each time updating
+        # W from the statistics of the earlier minibatches plus those
+        # of this one.  Only the last pass's statistics are kept.
+        H = None
+        for i in range(self.passes):
+            H = self._activations(X, H)
+            num, den = self._statistics(X, H)
+            if self._num is not None:
+                num = self._num + num
+                den = self._den + den
+            d = self._update_basis(num, den)
+            if self._num is not None:
+                self._num, self._den = self._rescale(self._num, self._den,
+                                                     d)
+
+        self._num, self._den = self._rescale(num, den, d)
+        self.n_frames += X.shape[1]
+        self.n_batches += 1
+
+        return H
+
+    def transform(self, X):
+        """
+            transform(X)
+                Activations of frames X over the current basis, which
+                is not changed.
+
+            Input
+            -----
+                X:    non-negative frames, size (n_freq, n_frames)
+
+            Returns
+            -------
+                H:    activations, size (K, n_frames)
+        """
+
+        if self.basis is None:
+            raise ValueError("The basis is not set; call partial_fit first")
+
+        return self._activations(self._frames(X))
+
+    def _frames(self, X):
+        X = np.ascontiguousarray(X, dtype=float)
+        if X.ndim == 1:
+            X = X[:, np.newaxis]
+
+        return X
+
+    def _activations(self, X, H=None):
+        # h_iter updates of H with the basis held, from H or, if None,
+        # from constant activations scaled so that W H has the mean of X
+
+        if H is None:
+            level = X.mean() * X.shape[0] / max(self.basis.sum(), _EPS)
+            H = np.full((self.n_components, X.shape[1]), max(level, _EPS))
+
+        return nmf(X, 'mu', basis=self.basis, activations=H, fix_basis=True,
+                   beta=self.beta, max_iter=self.h_iter, tol=0)[1]
+
+    def _statistics(self, X, H):
+        # Terms of the W update for the frames X.  For beta=2 these are
+        # X H' and H H', from which the multiplicative update can be
+        # made with any W.  Otherwise the terms depend on the W they
+        # were computed with, and they are those of the majorizing
+        # function of Lefevre et al. (2011), from which W is
+        # (num/den)**gamma.
+
+        W, beta = self.basis, self.beta
+        Ht = _T(H)
+        if beta == 2:
+            return X @ Ht, H @ Ht
+
+        if beta == 1:
+            num = W * ((X / _product(W, H)) @ Ht)
+            den = H.sum(axis=-1)[np.newaxis, :]
+        else:
+            WH = _product(W, H)
+            num = W ** (1 / self._gamma) * ((X * WH ** (beta - 2)) @ Ht)
+            den = WH ** (beta - 1) @ Ht
+
+        return num, den
+
+    def _update_basis(self, num, den):
+        # Updates W from the statistics, and scales its columns to unit
+        # sum.  Returns the scale factors.
+
+        W = self.basis
+        if self.beta == 2:
+            W = W * _ratio(num, W @ den, 1.)
+        else:
+            W = _ratio(num, den, self._gamma)
+
+        d = np.maximum(W.sum(axis=0), _EPS)
+        self.basis = W / d
+
+        return d
+
+    def _rescale(self, num, den, d):
+        # W H is unchanged if a column of W is divided by d and the row
+        # of H multiplied by it, so the scale of W would drift between
+        # minibatches.  When W is normalized this way, the statistics
+        # are rescaled as if H had been multiplied by d.
+
+        if self.beta == 2:
+            return num * d, den * np.outer(d, d)
+
+        return num * d ** (1 - 1 / self._gamma), den * d
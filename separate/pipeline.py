@@ -0,0 +1,202 @@
+# Author: Dan Valente
+
+import numpy as np
+from pythagoras.transforms import stft, istft, StreamSTFT, StreamISTFT
+from pythagoras.separate.nmf import nmf
+from pythagoras.separate.online import OnlineNMF
+from pythagoras.utils import utils, instrument
+
+
+@instrument.timed('separate')
+def separate(x, n_components=None, frame_size=2048, step_size=512, fs=44100,
+             nfft=None, taper_name='hanning', taper_param=None, power=2,
+             basis=None, fix_basis=False, block_frames=None, out=None,
+             dtype=None, **nmfparams):
+    """
+        separate(x, n_components=None, frame_size=2048, step_size=512,
+                 fs=44100, nfft=None, taper_name='hanning',
+                 taper_param=None, power=2, basis=None, fix_basis=False,
+                 block_frames=None, out=None, dtype=None, **nmfparams)
+            Separates a signal into the sources of an NMF of its
+            magnitude spectrogram.  The STFT S of x is taken, and its
+            magnitude factorized as |S| ~ W H.  Component k is
+            resynthesized from S through the soft (Wiener-like) mask
+
+                M_k = (W_k H_k)**power / sum_j (W_j H_j)**power
+
+            The masks of all components are built in one vectorized
+            pass and all sources are inverted in one batched istft.
+            The masks sum to 1, so the sources add up to x (wherever
+            the taper overlap is non-zero).
+
+            With block_frames, x is processed a block of frames at a
+            time (with StreamSTFT and StreamISTFT), so that only one
+            block of the spectrogram and its masks is in memory.  The
+            activations of each block are then found over the basis
+            (if fix_basis), or the basis is learned as the blocks go by
+            with OnlineNMF.
+
+        Input
+        -----
+            x:             the waveform to separate
+            n_components:  number of components (sources) K.  Defaults
+                           to the number of columns of basis.
+            frame_size, step_size, fs, nfft, taper_name, taper_param:
+                           the STFT parameters. See stft.  The default
+                           taper is 'hanning'.
+            power:         exponent of the masks: 2 for Wiener masks,
+                           1 for magnitude ratio masks
+            basis:         initial (or, with fix_basis, fixed) spectral
+                           templates W, size (nfft/2+1, K)
+            fix_basis:     if True, only the activations are found, e.g.
+                           to separate with a learned dictionary
+            block_frames:  number of STFT frames per block.  Default is
+                           to process the whole signal at once.
+            out:           if given, the sources are written to out
+                           instead of a new array, a block at a time
+                           with block_frames.  The name of a .npy file
+                           to create (as a memory map) or an array of
+                           the right size.  See utils.output_array.
+            dtype:         float dtype to compute the STFT and masks in.
+                           See stft.
+            nmfparams:     passed to nmf, e.g. method ('mu' by default),
+                           beta, max_iter, random_state.  With
+                           block_frames and a basis to learn, they are
+                           passed to OnlineNMF instead (beta, h_iter,
+                           passes, forget, random_state).
+
+        Returns
+        -------
+            (Y, W, H)
+                Y:    the sources, size (K, len(x))
+                W:    the basis, size (nfft/2+1, K).  With block_frames
+                      and a learned basis, the basis after the last
+                      block.
+                H:    the activations, size (K, n_frames)
+
+        Example
+        -------
+            Y, W, H = separate(x, n_components=4, beta=1)
+            Y, W, H = separate(x, basis=W, fix_basis=True,
+                               block_frames=256)
+
+        [REF]
+        Fevotte C, Bertin N and Durrieu JL (2009). Nonnegative matrix
+        factorization with the Itakura-Saito divergence: with
+        application to music analysis. Neural Computation
+        21(3):793-830
+    """
+
+    if fix_basis and basis is None:
+        raise ValueError("fix_basis requires basis")
+    if n_components is None:
+        if basis is None:
+            raise ValueError("n_components or basis must be given")
+        n_components = np.shape(basis)[-1]
+
+    if nfft is None:
+        nfft = int(utils.nextpow2(frame_size))
+
+    x = np.asarray(x)
+    stft_params = dict(frame_size=frame_size, step_size=step_size, fs=fs,
+                       nfft=nfft, taper_name=taper_name,
+                       taper_param=taper_param, one_sided=True)
+
+    if block_frames is None:
+        S = stft(x, dtype=dtype, **stft_params)[0]
+        W, H = _factorize(np.abs(S), n_components, basis, fix_basis,
+                          nmfparams)
+        Y = istft(_masked(S, W, H, power), length=len(x), **stft_params)
+        if out is not None:
+            Y_out = utils.output_array(out, Y.shape, Y.dtype)
+            Y_out[:] = Y
+            Y = Y_out
+        return Y, W, H
+
+    analyzer = StreamSTFT(dtype=dtype, **stft_params)
+    synthesizer = StreamISTFT(dtype=dtype, **stft_params)
+    if fix_basis:
+        model = None
+        W = basis
+    else:
+        model = OnlineNMF(n_components, basis=basis, **nmfparams)
+
+    shape = (n_components, len(x))
+    real = np.dtype(float if dtype is None else dtype)
+    if out is None:
+        Y = np.zeros(shape, dtype=real)
+    else:
+        Y = utils.output_array(out, shape, real)
+        Y[:] = 0
+
+    # Samples come out of the synthesizer once no later frame overlaps
+    # them, so the output lags the input by up to a frame
+    H = [np.zeros((n_components, 0))]
+    done = 0
+    chunk = block_frames * int(step_size)
+    for start in range(0, len(x), chunk):
+        S = analyzer.process(x[start:start + chunk])
+        if S.shape[1] == 0:
+            continue
+        if model is None:
+            H_block = _factorize(np.abs(S), n_components, W, True,
+                                 nmfparams)[1]
+        else:
+            H_block = model.partial_fit(np.abs(S))
+            W = model.basis
+        H.append(H_block)
+        done = _write(Y, synthesizer.process(_masked(S, W, H_block, power)),
+                      done)
+
+    _write(Y, synthesizer.flush(), done)
+    if hasattr(Y, 'flush'):
+        Y.flush()
+
+    return Y, W, np.concatenate(H, axis=1)
+
+
+def _write(Y, y, done):
+    # Writes the samples y after the first done samples of Y, and
+    # returns the number written so far
+
+    n = min(y.shape[-1], Y.shape[-1] - done)
+    Y[:, done:done + n] = y[..., :n]
+
+    return done + n
+
+
+def _factorize(V, n_components, basis, fix_basis, nmfparams):
+    # (W, H) of the magnitude spectrogram V with nmf
+
+    params = dict(nmfparams)
+    method = params.pop('method', 'mu')
+    if basis is not None:
+        params['basis'] = basis
+        params['fix_basis'] = fix_basis
+
+    with instrument.stage('nmf'):
+        W, H = nmf(V, method, n_components=n_components, **params)[:2]
+
+    return W, H
+
+
+def _masked(S, W, H, power):
+    # The spectrogram S masked for every component at once, size
+    # (K, n_freq, n_frames)
+
+    with instrument.stage('masks') as s:
+        # Component spectrograms W_k H_k, stacked along the first axis
+        V = W.T[:, :, np.newaxis] * H[:, np.newaxis, :]
+        if power != 1:
+            V **= power
+        total = V.sum(axis=0)
+
+        # Where every component vanishes (or underflows) the mixture is
+        # shared equally, so that the masks always sum to 1
+        zero = total <= np.finfo(total.dtype).tiny
+        total[zero] = 1
+        V /= total
+        V[:, zero] = 1. / V.shape[0]
+        V = V.astype(S.real.dtype, copy=False)
+
+        return s.output(V * S)
@@ -4,6 +4,9 @@ from .istft import istft
 from .cqt import cqt
 from .ceps import ceps
 from .mfcc import mfcc
+from .stream import StreamSTFT, StreamISTFT
+from .resample import resample, Resampler
+from .plan import FeaturePlan
 
 __all__ = ['tfft',
            'stft',
@@ -11,4 +14,9 @@ __all__ = ['tfft',
            'cqt',
            'ceps',
            'mfcc',
+           'StreamSTFT',
+           'StreamISTFT',
+           'resample',
+           'Resampler',
+           'FeaturePlan',
           ]
@@ -1,22 +1,35 @@
 # Author: Dan Valente
 
 import numpy as np
-from scipy.fftpack import ifft
-from pythagoras.transforms import tfft
-from pythagoras.utils import utils
+from pythagoras.transforms import tfft, stft
+from pythagoras.utils import utils, fft_backend, instrument, cache
 
+
+@instrument.timed('ceps')
+@cache.cached('ceps')
 def ceps(x, fs=44100, nfft=None, taper_name="rect", taper_param=1,
-         which_type='power'):
+         which_type='power', dtype=None, framewise=False, frame_size=None,
+         step_size=None, X=None, floor=None, n_quef=None):
     """
         ceps(x, fs=44100, nfft=None, taper_name="rect", taper_param=1,
-             which_type='power'):
-            Computes the cepstrum of the signal
+             which_type='power', dtype=None, framewise=False,
+             frame_size=None, step_size=None, X=None, floor=None,
+             n_quef=None):
+            Computes the cepstrum of the signal, either of the whole
+            signal or, if framewise, of every frame of its STFT (a
+            cepstrogram).  In the framewise case the log is taken of
+            the whole magnitude spectrogram at once, and all frames go
+            through one batched inverse FFT.  Several signals of the
+            same length, size (..., n_samples), are handled in one call
+            the same way.
 
         Input
         -----
-            x:             real-valued signal
+            x:             real-valued signal, or several, size
+                           (..., n_samples).  Ignored if X is given.
             fs:            sampling frequency of x
-            nfft:          size of the fft
+            nfft:          size of the fft.  Defaults as in tfft (whole
+                           signal) or stft (framewise), or to match X.
             taper_name:    the name of the taper to use.  Default is
                            rectangular ('rect'). See utils.get_taper for
                            options.
@@ -24,27 +37,110 @@ def ceps(x, fs=44100, nfft=None, taper_name="rect", taper_param=1,
                            options
             which_type:    type of cepstrum, 'real' or 'power' ('complex'
                            not yet implemented')
+            dtype:         float dtype to compute in, e.g. np.float32.
+                           See tfft.  If X is given, its precision is
+                           used instead.
+            framewise:     if True, the cepstrum of each STFT frame is
+                           returned
+            frame_size:    STFT frame size if framewise. See stft.
+            step_size:     STFT step size if framewise. See stft.
+            X:             a precomputed one-sided STFT, as from
+                           stft(one_sided=True), to use instead of x.
+                           Implies framewise.  A stack of them, size
+                           (..., nfft/2+1, n_frames), is also accepted.
+            floor:         magnitudes below floor are raised to it
+                           before the log, so that zeros in the spectrum
+                           give a finite cepstrum.  Default is the
+                           smallest normal number of the dtype, which
+                           only changes exact zeros.
+            n_quef:        if given, only the first n_quef quefrency
+                           bins (a low-quefrency lifter) are kept.  The
+                           frames are then inverse transformed a block
+                           at a time, so the full size cepstrogram is
+                           never in memory.
 
         Returns
         -------
         (C,quef)
-            C:     cepstrum
-            quef:  quefrency vector
+            C:     cepstrum, size (..., nfft), or (..., nfft, n_frames)
+                   if framewise (n_quef rather than nfft if given)
+            quef:  quefrency of each row of C (in s)
     """
-    if nfft is None:
-        nfft = int(utils.nextpow2(len(x)))
-
-    X = tfft(x, nfft, taper_name, taper_param)
-
-    if which_type == "real":
-        logX = np.log(np.abs(X))
-        C = np.real(ifft(logX))
-    elif which_type == "power":
-        logX = np.log(np.abs(X)**2)
-        C = np.abs(ifft(logX))**2
-    elif which_type == "complex":
+
+    if which_type == "complex":
         return "Complex cepstrum not yet implemented"
 
-    quef = np.linspace(0, len(x)/fs, len(x))
+    whole = X is None and not framewise
+    if X is not None:
+        if nfft is None:
+            nfft = 2 * (X.shape[-2] - 1)
+    elif framewise:
+        X = stft(x, frame_size, step_size, fs, nfft, taper_name,
+                 taper_param, one_sided=True, dtype=dtype)[0]
+        if nfft is None:
+            nfft = 2 * (X.shape[-2] - 1)
+    else:
+        if nfft is None:
+            nfft = int(utils.nextpow2(np.shape(x)[-1]))
+        X = tfft(x, nfft, taper_name, taper_param, one_sided=True,
+                 dtype=dtype)
+
+        # As a spectrogram of one frame
+        X = X[..., np.newaxis]
+
+    # The log spectrum of a real signal is real and even, so its inverse
+    # FFT can be taken from the one-sided spectrum alone. tfft doubles
+    # the one-sided spectrum, so undo that here.
+    S = np.abs(X)
+    S *= 0.5
+
+    C = _cepstrum(S, nfft, which_type, floor, n_quef)
+
+    quef = np.arange(C.shape[-2]) / float(fs)
+
+    return (C[..., 0] if whole else C), quef
+
+
+def _cepstrum(S, nfft, which_type, floor=None, n_quef=None):
+    # Cepstrum from a one-sided magnitude spectrogram S, with frequency
+    # along the second to last axis
+
+    if which_type not in ('real', 'power'):
+        raise ValueError("Unknown cepstrum type '%s'. Choices are: real, "
+                         "power" % which_type)
+
+    if floor is None:
+        floor = np.finfo(S.dtype).tiny
+
+    if n_quef is None or n_quef >= nfft:
+        return _log_irfft(S, nfft, which_type, floor)[..., :n_quef, :]
+
+    # A block of frames at a time, keeping only the first n_quef rows
+    n_frames = S.shape[-1]
+    block = max(1, 2**18 // (nfft * max(int(np.prod(S.shape[:-2])), 1)))
+    C = np.empty(S.shape[:-2] + (n_quef, n_frames), dtype=S.dtype,
+                 order='F')
+    for i in range(0, n_frames, block):
+        C[..., i:i + block] = _log_irfft(S[..., i:i + block], nfft,
+                                         which_type, floor)[..., :n_quef, :]
+
+    return C
+
+
+def _log_irfft(S, nfft, which_type, floor):
+    # The inverse FFT (along the second to last axis) of the log of the
+    # floored magnitude S, squared for the power cepstrum
+
+    with instrument.stage('log') as s:
+        logX = np.maximum(S, floor)
+        np.log(logX, out=logX)
+        if which_type == "power":
+            # log(S**2)
+            logX *= 2
+        s.output(logX)
+
+    C = fft_backend.irfft(logX, nfft, axis=-2)
+    if which_type == "power":
+        C **= 2
 
-    return C, quef
+    return C
@@ -1,22 +1,32 @@
 # Author: Dan Valente
 
 import numpy as np
-from pythagoras.utils import utils
+from pythagoras.utils import utils, fft_backend, instrument, cache
 from pythagoras.filter_banks import constq
+from pythagoras.filter_banks.constq import _n_bins
 from pythagoras.transforms import stft
+from pythagoras.transforms.stft import _blocks
 
 
+@instrument.timed('cqt')
+@cache.cached('cqt')
 def cqt(x, frame_size=None, step_size=None, nfft=None, fs=44100, fmin=100,
-        Q=34, n=12, kernel_taper='hamming'):
+        Q=34, n=12, kernel_taper='hamming', one_sided=False, sparse=False,
+        threshold=0.0054, multires=False, octave_hop=False, out=None,
+        block_frames=None, dtype=None):
     """
         cqt(x, frame_size, step_size=None, nfft=None, fs=44100, fmin=100,
-            Q=34, n=12, kernel_taper='hamming'):
+            Q=34, n=12, kernel_taper='hamming', one_sided=False,
+            sparse=False, threshold=0.0054, multires=False,
+            octave_hop=False, out=None, block_frames=None, dtype=None):
             Constant-Q Transform
             Uses kernel algorithm specified in Brown & Puckette (1992)
 
         Input
         -----
-            x:           input signal
+            x:           input signal, or several of the same length,
+                         size (..., n_samples), which are transformed
+                         together with one kernel
             frame_size:  the size of an STFT frame in samples.  Default
                          is 1/10 of sample rate.
             step_size:   the 'hop' or step size in samples to move the
@@ -30,32 +40,81 @@ def cqt(x, frame_size=None, step_size=None, nfft=None, fs=44100, fmin=100,
                          constant Q filter bank is based.
             Q:           the Q for each filter
             n:           number of Q bins (components) per octave
+            kernel_taper: the name of the taper used for the kernel
+            one_sided:   if True, the kernel is applied to the one-sided
+                         (real-input) STFT, which halves the FFT and
+                         matrix product work.  Since the kernels are
+                         analytic, the result closely matches the
+                         two-sided transform (to about 1%), except
+                         for bins within a bandwidth of fs/2.
+            sparse:      if True, a thresholded sparse kernel is used
+                         (see constq), which is much faster to apply
+                         for large nfft
+            threshold:   the kernel magnitude threshold if sparse
+            multires:    if True, the transform is computed one octave
+                         at a time: the top octave from x, and each
+                         lower octave from x decimated by a further
+                         factor of 2, all with the same small one-octave
+                         kernel.  nfft is then set by the kernel and
+                         ignored.  This gives the same bins (to within a
+                         few percent) at a fraction of the FFT size and
+                         kernel memory, especially for low fmin.  The
+                         spectrum is always one-sided.
+            octave_hop:  only used if multires.  If True, each octave
+                         uses a hop of step_size samples at its own
+                         (decimated) rate, so every octave down has half
+                         as many frames, and a list of arrays (one per
+                         octave, lowest first) is returned.
+            out:         if given, the transform is written to out a
+                         block of frames at a time.  See stft.  Not
+                         supported with multires.
+            block_frames: number of frames per block when out is given
+            dtype:       float dtype to compute in, e.g. np.float32, for
+                         the STFT and the kernel.  See tfft.
 
         Returns
         -------
-            Constant-Q transform
+            Constant-Q transform [np.array, size (Nq, n_frames), or
+                                  (..., Nq, n_frames)]
         [REF]
         Brown JC and Puckette MS (1992). An efficient algorithm for the
         calculation of a constant Q transform. J. Acoust. Soc. Am.
         92(5):2698-2701
+
+        Schoerkhuber C and Klapuri A (2010). Constant-Q transform
+        toolbox for music processing. 7th Sound and Music Computing
+        Conference, Barcelona.
      """
 
     ## TODO: Test
 
+    x = np.asarray(x)
+
     if frame_size is None:
         frame_size = fs/10
 
     if step_size is None:
         step_size = np.fix(frame_size/2)
 
+    step_size = int(step_size)
+
     if step_size >= frame_size:
         raise
 
+    if multires:
+        if out is not None:
+            raise ValueError("out is not supported with multires")
+        return _cqt_multires(x, int(frame_size), step_size, fs, fmin, Q, n,
+                             kernel_taper, sparse, threshold, octave_hop,
+                             dtype)
+
     if nfft is None:
-        nfft = int(utils.nextpow2(len(x)))
+        nfft = int(utils.nextpow2(x.shape[-1]))
 
-    #Create the kernel (really, a filter bank that operates on STFT)
-    qbank = constq(fmin, Q, n, fs, nfft, kernel_taper)
+    #Create the kernel (really, a filter bank that operates on STFT).
+    #Kernels are cached by constq, so this is only slow on first use.
+    qbank = constq(fmin, Q, n, fs, nfft, kernel_taper, one_sided, sparse,
+                   threshold, dtype=dtype)
 
     # Take the STFT.  Honestly, you don't need to use a rectangular
     # taper, but if you choose another taper here, you'd essentially be
@@ -63,7 +122,105 @@ def cqt(x, frame_size=None, step_size=None, nfft=None, fs=44100, fmin=100,
     # though, since it would effectively be a taper with sharper
     # transitions to zero.
 
-    X = stft(x, frame_size, step_size=step_size, fs=44100, nfft=nfft,
-             taper_name='rect')
+    # tfft doubles the one-sided spectrum
+    scale = 0.5/nfft if one_sided else 1./nfft
+
+    if out is not None:
+        frame_size = int(frame_size)
+        n_frames = len(range(0, x.shape[-1] - frame_size, step_size))
+        C = utils.output_array(out, x.shape[:-1] + (qbank.shape[0], n_frames),
+                               np.result_type(dtype, np.complex64))
+        for i, X in _blocks(x, frame_size, step_size, nfft, 'rect', None,
+                            one_sided, block_frames, dtype):
+            with instrument.stage('kernel_product'):
+                C_block = utils._bank_product(qbank, X)
+                C[..., i:i + X.shape[-1]] = scale * C_block
+        if hasattr(C, 'flush'):
+            C.flush()
+        return C
+
+    X, freq, time = stft(x, frame_size, step_size=step_size, fs=fs,
+                         nfft=nfft, taper_name='rect', one_sided=one_sided,
+                         dtype=dtype)
+
+    with instrument.stage('kernel_product') as s:
+        return s.output(scale * utils._bank_product(qbank, X))
+
+
+def _cqt_multires(x, frame_size, step_size, fs, fmin, Q, n, kernel_taper,
+                  sparse, threshold, octave_hop, dtype=None):
+    # Octave-by-octave CQT.  The top octave is computed from x with its
+    # own kernel.  The kernel for the octave below it lies under fs/4,
+    # so it can be reused for every lower octave L on x decimated by
+    # 2**(L-1), where the bins sit in the same place relative to the
+    # sample rate and well inside the pass band of the decimation
+    # filter.  Each frame covers the same span of time as the frames of
+    # the direct transform, so results match it.
+
+    # scipy.signal is slow to import, so only multires pays for it
+    from scipy.signal import resample_poly
+
+    Nq = _n_bins(fmin, n, fs)
+    n_oct = -(-Nq // n)
+    n_samples = x.shape[-1]
+    n_frames = len(range(0, n_samples - frame_size, step_size))
+
+    kernels = []
+    for L in range(min(n_oct, 2)):
+        # Lowest frequency of octave L, which may be below fmin if the
+        # octave is only partly used.
+        f0 = fmin * 2 ** ((Nq - (L + 1) * n) / float(n))
+        nfft = int(utils.nextpow2(np.round(fs / f0 * Q)))
+        K = constq(f0, Q, n, fs, nfft, kernel_taper, True, sparse,
+                   threshold, nbins=n, dtype=dtype)
+        kernels.append((K, nfft))
+
+    C = []
+    xl = np.asarray(x, dtype=float if dtype is None else dtype)
+    for L in range(n_oct):
+        K, nfft = kernels[min(L, 1)]
+        decim = 2 ** max(L - 1, 0)
+        if L >= 2:
+            with instrument.stage('resample') as s:
+                xl = s.output(resample_poly(xl, 1, 2, axis=-1))
+
+        # Drop the kernel rows below fmin in a partial lowest octave
+        nrows = min(n, Nq - L * n)
+        K = K[n - nrows:]
+
+        if octave_hop:
+            nf = len(range(0, n_samples - frame_size, step_size * decim))
+            starts = np.arange(nf) * step_size
+        else:
+            starts = np.round(np.arange(n_frames) * step_size / float(decim))
+            starts = starts.astype(int)
+
+        flen = min(-(-frame_size // decim), nfft)
+        frames = _gather_frames(xl, starts, flen)
+
+        X = np.swapaxes(fft_backend.rfft(frames, nfft, axis=-1), -1, -2)
+        with instrument.stage('kernel_product') as s:
+            C.append(s.output((1. / (nfft * frame_size))
+                              * utils._bank_product(K, X)))
+
+    C = C[::-1]
+    if octave_hop:
+        return C
+
+    return np.concatenate(C, axis=-2)
+
+
+def _gather_frames(x, starts, flen):
+    # Frames of length flen starting at the given sample indices, zero
+    # padded past the end of x (along its last axis)
+
+    if len(starts) == 0:
+        return np.empty(x.shape[:-1] + (0, flen), dtype=x.dtype)
+
+    end = starts[-1] + flen
+    if end > x.shape[-1]:
+        pad = np.zeros(x.shape[:-1] + (end - x.shape[-1],), dtype=x.dtype)
+        x = np.concatenate([x, pad], axis=-1)
+    frames = np.lib.stride_tricks.sliding_window_view(x, flen, axis=-1)
 
-    return (1./nfft) * np.dot(qbank, X)
+    return frames[..., starts, :]
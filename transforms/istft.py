@@ -1,23 +1,178 @@
 #Author: Dan Valente
 
 import numpy as np
-from scipy.fftpack import ifft
+from pythagoras.utils import utils, fft_backend, instrument
 
 
-def istft(X, fs, T, step_size=None):
+@instrument.timed('istft')
+def istft(X, frame_size=None, step_size=None, fs=44100, nfft=None,
+          taper_name='rect', taper_param=None, one_sided=False, length=None):
     """
-        istft
+        istft(X, frame_size=None, step_size=None, fs=44100, nfft=None,
+              taper_name='rect', taper_param=None, one_sided=False,
+              length=None)
+            Inverse Short-time Fourier Transform by weighted
+            overlap-add.  All frames are inverse transformed in one
+            batched real FFT, multiplied by the synthesis taper and
+            overlap-added, and the sum is divided by the overlap-added
+            squared taper.  With the same arguments that were given to
+            stft, this reconstructs the signal exactly (up to rounding)
+            wherever the taper is non-zero.  For a modified STFT it
+            gives the least squares estimate of Griffin & Lim (1984).
 
+        Input
+        -----
+            X:             short-time Fourier transform, size
+                           (nfft, n_frames), or (nfft/2+1, n_frames)
+                           if one_sided.  It is assumed to be the STFT
+                           of a real signal, so only the non-negative
+                           frequency bins are used.  A stack of STFTs,
+                           size (..., nfft, n_frames), is inverted in
+                           one call.
+            frame_size:    the size of a frame in samples.  Defaults to
+                           1/10 of sample rate, as in stft.
+            step_size:     the 'hop' or step size in samples.  Default
+                           is to half the frame size, as in stft.
+            fs:            sampling frequency of the signal.  Only used
+                           for the default frame_size.
+            nfft:          number of points in the fft.  Defaults to the
+                           size of X (see X above).
+            taper_name:    the type of taper used in stft. See
+                           utils.get_taper for options.
+            taper_param:   parameter for taper. See utils.get_taper for
+                           options
+            one_sided:     set to True if X is one-sided, as from
+                           stft(one_sided=True)
+            length:        if given, the output is truncated or zero
+                           padded to this many samples
+
+        Returns
+        -------
+            y:             the reconstructed waveform, of length
+                           (n_frames - 1)*step_size + frame_size unless
+                           length is given, or size (..., length) for
+                           a stack of STFTs.  It is float32 if X is
+                           complex64 (e.g. from stft(dtype=np.float32)),
+                           and float64 otherwise.
+
+        [REF]
+        Griffin DW and Lim JS (1984). Signal estimation from modified
+        short-time Fourier transform. IEEE Trans. Acoust., Speech,
+        Signal Process. 32(2):236-243
     """
-    # TODO: Fix end-points and scaling
-    # TODO: Check if same taper has to be applied after ifft as was applied in STFT
-    # TODO: Error checks
-    # TODO: Documentation
 
-    y = np.zeros(T*fs)
-    nfft = X.shape[0]
+    if frame_size is None:
+        frame_size = int(fs/10)
+
+    frame_size = int(frame_size)
+
+    if step_size is None:
+        step_size = np.fix(frame_size/2)
+
+    step_size = int(step_size)
+
+    if step_size >= frame_size:
+        raise ValueError("step_size must be smaller than frame_size")
+
+    if nfft is None:
+        if one_sided:
+            nfft = 2 * (X.shape[-2] - 1)
+        else:
+            nfft = X.shape[-2]
+
+    if nfft < frame_size:
+        raise ValueError("nfft must be at least frame_size")
+
+    w = utils.normalized_taper(taper_name, frame_size, taper_param,
+                               _real_dtype(X))
+
+    frames = _synthesis_frames(X, frame_size, nfft, w, one_sided)
+    with instrument.stage('overlap_add') as s:
+        y = s.output(_overlap_add(frames, step_size))
+
+    # Window-sum envelope, the same for every STFT of a stack.  Samples
+    # where it vanishes (e.g. the end points of a hanning taper) cannot
+    # be recovered and are set to 0.
+    with instrument.stage('normalize') as s:
+        env = _overlap_add(np.broadcast_to(w ** 2, frames.shape[-2:]),
+                           step_size)
+        y = s.output(_normalize(y, env))
+
+    if length is not None:
+        y = _fix_length(y, length)
+
+    return y
+
+
+def _real_dtype(X):
+    # The taper precision matching the spectrum X: float32 for single
+    # precision spectra, and otherwise the default (float64)
+
+    if np.asarray(X).dtype in (np.complex64, np.float32):
+        return np.dtype(np.float32)
+
+    return None
 
-    for n, i in enumerate(range(0, len(y) - nfft, step_size)):
-        y[i:i + nfft] += np.squeeze(np.real(ifft(X[:, n])))
+
+def _synthesis_frames(X, frame_size, nfft, w, one_sided):
+    # Inverse transform every column of X in one call and apply the
+    # synthesis taper.  Returns an array of size (..., n_frames,
+    # frame_size).
+
+    Xt = np.swapaxes(X, -1, -2)
+    if one_sided:
+        # tfft doubles the one-sided spectrum
+        frames = fft_backend.irfft(0.5 * Xt, nfft, axis=-1)
+    else:
+        frames = fft_backend.irfft(Xt[..., :nfft//2 + 1], nfft, axis=-1)
+
+    return frames[..., :frame_size] * w
+
+
+def _overlap_add(frames, step_size):
+    # Overlap-adds the rows of frames (over the last two axes), each
+    # shifted by step_size from the last.  Rather than adding one frame
+    # at a time, every frame is cut into blocks of step_size samples and
+    # block j of all frames is added at once, so the loop runs
+    # ceil(frame_size/step_size) times.
+
+    lead = frames.shape[:-2]
+    n_frames, frame_size = frames.shape[-2:]
+    n_blocks = -(-frame_size // step_size)
+
+    padded = np.zeros(lead + (n_frames, n_blocks * step_size),
+                      dtype=frames.dtype)
+    padded[..., :frame_size] = frames
+    padded = padded.reshape(lead + (n_frames, n_blocks, step_size))
+
+    y = np.zeros(lead + (n_frames + n_blocks - 1, step_size),
+                 dtype=frames.dtype)
+    for j in range(n_blocks):
+        y[..., j:j + n_frames, :] += padded[..., j, :]
+
+    length = (n_frames - 1) * step_size + frame_size if n_frames else 0
+
+    return y.reshape(lead + (-1,))[..., :length]
+
+
+def _normalize(y, env):
+    # Divides y (..., n_samples) by the window-sum envelope env, setting
+    # samples where the envelope vanishes to 0
+
+    y = y.copy()
+    nz = env > np.finfo(float).tiny
+    y[..., nz] /= env[nz]
+    y[..., ~nz] = 0
 
     return y
+
+
+def _fix_length(y, length):
+    # Truncates or zero pads y to length samples along the last axis
+
+    if y.shape[-1] >= length:
+        return y[..., :length]
+
+    pad = np.zeros(y.shape[:-1] + (length - y.shape[-1],), dtype=y.dtype)
+
+    return np.concatenate([y, pad], axis=-1)
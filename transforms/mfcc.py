@@ -1,34 +1,127 @@
 # Author: Dan Valente
 
+from functools import lru_cache
+
 import numpy as np
-from scipy.fftpack import dct
-from pythagoras.transforms import tfft
-from pythagoras.filter_banks import mel
+from pythagoras.transforms import tfft, stft
+from pythagoras.filter_banks import mel, apply_mel
+from pythagoras.utils import utils, fft_backend, instrument, cache
 
 
-def mfcc(x, fs, fstart, nfft, nfilt):
+@instrument.timed('mfcc')
+@cache.cached('mfcc')
+def mfcc(x, fs=44100, fstart=0, nfft=None, nfilt=40, n_coeffs=None,
+         framewise=False, frame_size=None, step_size=None, taper_name='rect',
+         taper_param=None, X=None, dtype=None):
     """
-        mfcc
+        mfcc(x, fs=44100, fstart=0, nfft=None, nfilt=40, n_coeffs=None,
+             framewise=False, frame_size=None, step_size=None,
+             taper_name='rect', taper_param=None, X=None, dtype=None)
+            Mel-frequency cepstral coefficients, either of the whole
+            signal or, if framewise, of every frame of its STFT.  In the
+            framewise case the (cached) mel filter bank is applied to
+            all frames in one product, and the log and DCT are taken
+            along the filter axis of the whole matrix.  Several signals
+            of the same length, size (..., n_samples), are handled in
+            one call the same way, with one filter bank for all.
+
+        Input
+        -----
+            x:             the waveform, or several, size
+                           (..., n_samples).  Ignored if X is given.
+            fs:            sampling frequency of x
+            fstart:        start frequency of the mel filter bank
+            nfft:          number of points in the fft.  Defaults as in
+                           tfft (whole signal) or stft (framewise), or
+                           to match X.
+            nfilt:         number of mel filters
+            n_coeffs:      if given, only the first n_coeffs
+                           coefficients are computed
+            framewise:     if True, the coefficients of each STFT frame
+                           are returned
+            frame_size:    STFT frame size if framewise. See stft.
+            step_size:     STFT step size if framewise. See stft.
+            taper_name:    the type of taper to use. See
+                           utils.get_taper for options.
+            taper_param:   parameter for taper. See utils.get_taper for
+                           options
+            X:             a precomputed one-sided STFT, as from
+                           stft(one_sided=True), to use instead of x.
+                           Implies framewise.  A stack of them, size
+                           (..., nfft/2+1, n_frames), is also accepted.
+            dtype:         float dtype to compute in, e.g. np.float32.
+                           See tfft.  If X is given, its precision is
+                           used instead.
+
+        Returns
+        -------
+            coefficients [np.array, size (..., n_coeffs), or
+                          (..., n_coeffs, n_frames) if framewise]
     """
 
     ## TODO: Test that mfcc gives proper coefficients
-    ## TODO: Clean up / streamline input arguments
-    ## TODO: Allow other FFT input arguments
-    ## TODO: Documentation 
 
-    #Take the FFT
-    X = tfft(x, nfft)
+    whole = X is None and not framewise
+    if X is not None:
+        if nfft is None:
+            nfft = 2 * (X.shape[-2] - 1)
+    elif framewise:
+        X = stft(x, frame_size, step_size, fs, nfft, taper_name,
+                 taper_param, one_sided=True, dtype=dtype)[0]
+        if nfft is None:
+            nfft = 2 * (X.shape[-2] - 1)
+    else:
+        #Take the one-sided FFT
+        if nfft is None:
+            nfft = int(utils.nextpow2(np.shape(x)[-1]))
+        X = tfft(x, nfft, taper_name, taper_param, one_sided=True,
+                 dtype=dtype)
+
+        #As a spectrogram of one frame
+        X = X[..., np.newaxis]
+
+    #tfft doubles the one-sided spectrum, so undo that here
+    S = 0.5 * np.abs(X)
+
+    C = _mfcc_from_magnitude(S, fs, fstart, nfft, nfilt, n_coeffs)
+
+    return C[..., 0] if whole else C
 
-    #Get one-sided spectrum
-    S = np.abs(X[:nfft/2 + 1])
-    #Generate filter bank
-    mel_bank = mel(fstart, fs, nfilt, nfft)
+
+def _mfcc_from_magnitude(S, fs, fstart, nfft, nfilt, n_coeffs):
+    # MFCCs from a one-sided magnitude spectrogram S, with frequency
+    # along the second to last axis, in the precision of S
+
+    #Generate filter bank (cached by mel)
+    mel_bank = mel(fstart, fs, nfilt, nfft, sparse=True, dtype=S.dtype)
 
     #Apply the filter bank
-    S_filt = np.dot(mel_bank.T, S)
+    with instrument.stage('mel_product') as s:
+        S_filt = s.output(apply_mel(mel_bank, S))
 
     #Log transform
-    S_log = np.log(S_filt)
+    with instrument.stage('log') as s:
+        S_log = s.output(np.log(S_filt))
 
     #Discrete cosine transform to get the cepstral coefficients
-    return dct(S_log)
+    if n_coeffs is None or n_coeffs >= nfilt:
+        return fft_backend.dct(S_log, axis=-2)
+
+    #Only the first n_coeffs rows of the DCT are needed
+    D = _dct_matrix(n_coeffs, nfilt, S_log.dtype)
+    with instrument.stage('dct_product') as s:
+        return s.output(np.matmul(D, S_log))
+
+
+@lru_cache(maxsize=8)
+def _dct_matrix(n_coeffs, nfilt, dtype):
+    # First n_coeffs rows of the (unnormalized) type II DCT matrix, as
+    # computed by fft_backend.dct
+
+    k = np.arange(n_coeffs)[:, np.newaxis]
+    i = np.arange(nfilt)
+    D = 2 * np.cos(np.pi * k * (2 * i + 1) / (2. * nfilt))
+    D = D.astype(dtype)
+    D.setflags(write=False)
+
+    return D
@@ -0,0 +1,330 @@
+# Author: Dan Valente
+
+import numpy as np
+from pythagoras.transforms import tfft
+from pythagoras.transforms.resample import Resampler
+from pythagoras.transforms.mfcc import _mfcc_from_magnitude
+from pythagoras.transforms.ceps import _cepstrum
+from pythagoras.filter_banks import constq
+from pythagoras.utils import utils, instrument
+
+
+class FeaturePlan(object):
+    """
+        FeaturePlan(fs=44100, frame_size=None, step_size=None, nfft=None,
+                    taper_name='rect', taper_param=None, dtype=None,
+                    fs_out=None, band=None)
+            Computes several framewise features of one signal while
+            running each shared stage (framing, tapered FFT, magnitude,
+            power) only once.  Features are declared with add() and
+            computed with run().  Every feature gets the framing
+            arguments given here unless it overrides them, and features
+            with matching framing share all stages up to where they
+            differ.
+
+            All spectra are one-sided, as from stft(one_sided=True).
+
+            With fs_out or band, run() first resamples the signal (see
+            Resampler), and every feature is computed at the new
+            rate, which is then the plan's fs: e.g. band=8000 halves
+            the signal at 44.1 kHz, and the cost of every stage with
+            it.  The framing defaults given here are then in samples
+            at the new rate.
+
+        Input
+        -----
+            fs, frame_size, step_size, nfft, taper_name, taper_param:
+                           defaults for every feature.  See stft.
+            dtype:         float dtype every stage and feature is
+                           computed in, e.g. np.float32.  See tfft.
+            fs_out, band:  the sample rate to analyze at, or the highest
+                           frequency to keep.  See Resampler.  Default
+                           is to analyze at fs.
+
+        Features
+        --------
+            'stft':        the one-sided STFT
+            'power':       the power spectrogram |X|**2, with X the
+                           one-sided STFT as returned by stft
+            'mfcc':        framewise mfcc. Options: fstart, nfilt,
+                           n_coeffs.  See mfcc.
+            'cqt':         constant-Q transform from the shared
+                           spectrum. Options: fmin, Q, n, kernel_taper,
+                           sparse, threshold.  See cqt.  Note that cqt
+                           itself uses a rectangular taper and defaults
+                           nfft to the next power of 2 above len(x),
+                           not above frame_size, so pass
+                           taper_name='rect' and that nfft to
+                           reproduce it exactly (at the cost of a
+                           separate spectrum if the plan uses other
+                           ones).
+            'ceps':        framewise cepstrum. Options: which_type, floor,
+                           n_quef.  See ceps.
+
+        Example
+        -------
+            plan = FeaturePlan(frame_size=1024, step_size=256,
+                               taper_name='hanning')
+            plan.add('stft').add('mfcc', n_coeffs=13).add('ceps')
+            features = plan.run(x)
+            plan.report()
+    """
+
+    _framing = ('frame_size', 'step_size', 'nfft', 'taper_name',
+                'taper_param')
+
+    def __init__(self, fs=44100, frame_size=None, step_size=None, nfft=None,
+                 taper_name='rect', taper_param=None, dtype=None,
+                 fs_out=None, band=None):
+
+        if fs_out is None and band is None:
+            self.resampler = None
+        else:
+            self.resampler = Resampler(fs, fs_out, band)
+            fs = self.resampler.fs_out
+
+        self.fs = fs
+        self.dtype = dtype
+        self.defaults = dict(frame_size=frame_size, step_size=step_size,
+                             nfft=nfft, taper_name=taper_name,
+                             taper_param=taper_param)
+        self.features = {}
+        self.computed = {}
+
+    def add(self, kind, name=None, **params):
+        """
+            add(kind, name=None, **params)
+                Declares a feature.
+
+            Input
+            -----
+                kind:      one of the features listed in FeaturePlan
+                name:      key of the feature in the output of run().
+                           Defaults to kind.
+                params:    options of the feature, and any framing
+                           arguments that override the plan's
+
+            Returns
+            -------
+                the plan, so calls can be chained
+        """
+
+        if kind not in _features:
+            raise ValueError("Unknown feature '%s'. Choices are: %s"
+                             % (kind, ', '.join(sorted(_features))))
+
+        if name is None:
+            name = kind
+
+        if name in self.features:
+            raise ValueError("Feature '%s' was already added" % name)
+
+        framing = dict(self.defaults)
+        for key in self._framing:
+            if key in params:
+                framing[key] = params.pop(key)
+
+        self.features[name] = (kind, self._resolve(framing), params)
+
+        return self
+
+    def stages(self):
+        """
+            stages()
+                The shared stages each feature depends on.
+
+            Returns
+            -------
+                dict mapping each feature name to its list of stage
+                keys, in the order they are computed
+        """
+
+        return dict((name, _chain(_stage_of[kind], framing))
+                    for name, (kind, framing, params)
+                    in self.features.items())
+
+    def report(self):
+        """
+            report()
+                Describes which stages are shared between features, and
+                how many times each stage was computed by the last run().
+
+            Returns
+            -------
+                dict mapping a description of each stage to a dict with
+                    'features':  names of the features that use it
+                    'shared':    True if more than one feature uses it
+                    'computed':  times it was computed in the last run
+        """
+
+        users = {}
+        for name, chain in self.stages().items():
+            for key in chain:
+                users.setdefault(key, []).append(name)
+
+        return dict((_describe(key), {'features': names,
+                                      'shared': len(names) > 1,
+                                      'computed': self.computed.get(key, 0)})
+                    for key, names in users.items())
+
+    @instrument.timed('plan')
+    def run(self, x):
+        """
+            run(x)
+                Computes every declared feature of x.
+
+            Input
+            -----
+                x:     the waveform, at the plan's input rate, or
+                       several, size (..., n_samples).  Each feature
+                       then has the same leading dimensions.
+
+            Returns
+            -------
+                dict mapping each feature name to its value
+        """
+
+        cache = {}
+        self.computed = {}
+
+        if self.resampler is not None:
+            with instrument.stage('resample') as s:
+                x = s.output(np.concatenate([self.resampler.process(x),
+                                             self.resampler.flush()],
+                                            axis=-1))
+
+        out = {}
+        for name, (kind, framing, params) in self.features.items():
+            chain = _chain(_stage_of[kind], framing)
+            X = self._stage(chain[-1], x, cache)
+            with instrument.stage(name) as s:
+                out[name] = s.output(_features[kind](self, X, framing,
+                                                     **params))
+
+        return out
+
+    def _resolve(self, framing):
+        # Fills in the stft defaults, so that equal framing gives equal
+        # stage keys
+
+        if framing['frame_size'] is None:
+            framing['frame_size'] = int(self.fs/10)
+
+        framing['frame_size'] = int(framing['frame_size'])
+
+        if framing['step_size'] is None:
+            framing['step_size'] = np.fix(framing['frame_size']/2)
+
+        framing['step_size'] = int(framing['step_size'])
+
+        if framing['step_size'] >= framing['frame_size']:
+            raise ValueError("step_size must be smaller than frame_size")
+
+        if framing['nfft'] is None:
+            framing['nfft'] = int(utils.nextpow2(framing['frame_size']))
+
+        return framing
+
+    def _stage(self, key, x, cache):
+        # Computes (or fetches) one stage and, recursively, the stages
+        # it depends on
+
+        if key in cache:
+            return cache[key]
+
+        with instrument.stage(key[0]) as s:
+            value = s.output(self._compute(key, x, cache))
+
+        cache[key] = value
+        self.computed[key] = self.computed.get(key, 0) + 1
+
+        return value
+
+    def _compute(self, key, x, cache):
+        # The value of one stage, from the stages it depends on
+
+        stage = key[0]
+        if stage == 'frames':
+            value = utils.frame(x, key[1], key[2])
+        elif stage == 'spectrum':
+            frames = self._stage(('frames',) + key[1:3], x, cache)
+            value = np.swapaxes(tfft(frames, key[3], key[4], key[5],
+                                     one_sided=True, dtype=self.dtype),
+                                -1, -2)
+        elif stage == 'magnitude':
+            # tfft doubles the one-sided spectrum, so undo that here
+            value = 0.5 * np.abs(self._stage(('spectrum',) + key[1:], x,
+                                             cache))
+        elif stage == 'power':
+            # |X|**2 of the (doubled) spectrum, as from stft
+            value = self._stage(('magnitude',) + key[1:], x, cache) ** 2
+            value *= 4
+
+        return value
+
+
+def _chain(last, framing):
+    # Stage keys from framing up to the stage named last
+
+    spec = (framing['frame_size'], framing['step_size'], framing['nfft'],
+            framing['taper_name'], framing['taper_param'])
+    chain = [('frames',) + spec[:2], ('spectrum',) + spec,
+             ('magnitude',) + spec, ('power',) + spec]
+
+    names = [key[0] for key in chain]
+
+    return chain[:names.index(last) + 1]
+
+
+def _describe(key):
+    # A readable name for a stage key
+
+    labels = ('frame_size', 'step_size', 'nfft', 'taper_name', 'taper_param')
+    args = ', '.join('%s=%s' % (label, value)
+                     for label, value in zip(labels, key[1:]))
+
+    return '%s(%s)' % (key[0], args)
+
+
+def _stft(plan, X, framing):
+    return X
+
+
+def _power(plan, X, framing):
+    return X
+
+
+def _mfcc(plan, S, framing, fstart=0, nfilt=40, n_coeffs=None):
+    return _mfcc_from_magnitude(S, plan.fs, fstart, framing['nfft'], nfilt,
+                                n_coeffs)
+
+
+def _cqt(plan, X, framing, fmin=100, Q=34, n=12, kernel_taper='hamming',
+         sparse=False, threshold=0.0054):
+    nfft = framing['nfft']
+    qbank = constq(fmin, Q, n, plan.fs, nfft, kernel_taper, True, sparse,
+                   threshold, dtype=plan.dtype)
+
+    # As in cqt, undoing the doubling of the one-sided spectrum
+    return (0.5/nfft) * utils._bank_product(qbank, X)
+
+
+def _ceps(plan, S, framing, which_type='power', floor=None, n_quef=None):
+    return _cepstrum(S, framing['nfft'], which_type, floor, n_quef)
+
+
+# The last shared stage each feature needs, and the function that
+# finishes it
+_stage_of = {'stft': 'spectrum',
+             'power': 'power',
+             'mfcc': 'magnitude',
+             'cqt': 'spectrum',
+             'ceps': 'magnitude',
+             }
+
+_features = {'stft': _stft,
+             'power': _power,
+             'mfcc': _mfcc,
+             'cqt': _cqt,
+             'ceps': _ceps,
+             }
@@ -0,0 +1,206 @@
+# Author: Dan Valente
+
+from fractions import Fraction
+from functools import lru_cache
+
+import numpy as np
+from pythagoras.utils import instrument
+
+
+class Resampler(object):
+    """
+        Resampler(fs, fs_out=None, band=None, quality=10)
+            Polyphase resampling of a signal that arrives in chunks,
+            e.g. in front of StreamSTFT, to analyze it at a lower
+            sample rate.  The rate is changed by a rational factor
+            up/down: the signal is (in effect) upsampled by up, low
+            pass filtered and downsampled by down, but only the
+            filter taps that meet non-zero input samples are computed
+            for the outputs that are kept.
+
+            Each call to process() returns the output samples that are
+            complete, and flush() the rest.  Their concatenation is
+            the same as resample() of the whole signal: the filter's
+            delay is removed, so output sample j is at time j/fs_out.
+            Chunks of several signals, size (..., n_samples), are
+            resampled together along the last axis.
+
+        Input
+        -----
+            fs:        sample rate of the input
+            fs_out:    sample rate of the output.  up/down is its ratio
+                       to fs (with down at most 1000).
+            band:      instead of fs_out, the highest frequency (in Hz)
+                       to keep.  The input is then decimated by the
+                       largest integer factor that keeps band below
+                       90% of the output's Nyquist frequency.
+            quality:   half the length of the low pass filter, in
+                       periods of its cutoff.  The filter is a Kaiser
+                       windowed sinc (beta 5), as in
+                       scipy.signal.resample_poly.
+
+        Attributes
+        ----------
+            fs_out:    sample rate of the output, to pass on as fs to
+                       the transforms (stft, mfcc, cqt, mel)
+            up, down:  the resampling factors
+
+        Example
+        -------
+            resampler = Resampler(44100, band=8000)
+            analyzer = StreamSTFT(fs=resampler.fs_out, frame_size=512,
+                                  step_size=128, one_sided=True)
+            for chunk in chunks:
+                S = analyzer.process(resampler.process(chunk))
+    """
+
+    def __init__(self, fs, fs_out=None, band=None, quality=10):
+
+        if fs_out is None:
+            if band is None:
+                raise ValueError("fs_out or band must be given")
+            ratio = Fraction(1, max(1, int(0.45 * fs / band)))
+        else:
+            ratio = Fraction(fs_out / float(fs)).limit_denominator(1000)
+
+        self.fs = fs
+        self.up = ratio.numerator
+        self.down = ratio.denominator
+        self.fs_out = fs * ratio.numerator / float(ratio.denominator)
+        self.quality = quality
+        self._h, self._delay = _lowpass(self.up, self.down, quality)
+
+        # Number of input samples each output depends on
+        self._taps = -(-len(self._h) // self.up)
+        self.reset()
+
+    def reset(self):
+        """
+            reset()
+                Discards any buffered samples and starts a new stream.
+        """
+        self._buffer = None
+        self._start = 0
+        self.n_in = 0
+        self.n_out = 0
+
+    @instrument.timed('resample')
+    def process(self, x):
+        """
+            process(x)
+                Adds the chunk x to the stream.
+
+            Input
+            -----
+                x:    the next samples of the input (any length), or
+                      of several signals, size (..., n_samples)
+
+            Returns
+            -------
+                y:    the output samples completed by x
+        """
+
+        x = np.asarray(x)
+        self._append(x)
+        self.n_in += x.shape[-1]
+
+        # Outputs whose last input sample has arrived
+        return self._outputs(-(-self.n_in * self.up // self.down))
+
+    def flush(self):
+        """
+            flush()
+                Returns the rest of the output, as if the input were
+                followed by zeros, and resets the stream.
+        """
+
+        if self._buffer is None:
+            self._append(np.zeros(0))
+        self._append(np.zeros(self._buffer.shape[:-1] + (self._taps,)))
+        y = self._outputs(self._delay
+                          + -(-self.n_in * self.up // self.down))
+        self.reset()
+
+        return y
+
+    def _append(self, x):
+        if self._buffer is None:
+            self._buffer = x
+        else:
+            self._buffer = np.concatenate([self._buffer, x], axis=-1)
+
+    def _outputs(self, end):
+        # Causal filter outputs from the next one up to end (exclusive),
+        # less the first self._delay, which only make up the filter's
+        # delay.  Outputs are counted from the start of the stream.
+
+        from scipy.signal import upfirdn
+
+        up, down = self.up, self.down
+        first = self.n_out + self._delay
+        end = max(end, first)
+
+        # The buffer starts at an input sample that is a multiple of
+        # down, so that the outputs of upfirdn on it are outputs of the
+        # whole stream: number self._start*up/down onwards
+        offset = self._start * up // down
+        y = upfirdn(self._h, self._buffer, up, down,
+                    axis=-1)[..., first - offset:end - offset]
+        self.n_out += y.shape[-1]
+
+        # Keep the inputs that the next output depends on
+        next_out = self.n_out + self._delay
+        needed = max(0, next_out * down // up - self._taps + 1)
+        start = max(self._start, needed - needed % down)
+        self._buffer = self._buffer[..., start - self._start:]
+        self._start = start
+
+        return y
+
+
+def resample(x, fs, fs_out=None, band=None, quality=10):
+    """
+        resample(x, fs, fs_out=None, band=None, quality=10)
+            Resamples a signal with a polyphase filter.  See Resampler.
+
+        Input
+        -----
+            x:         the waveform, or several, size (..., n_samples)
+            fs:        its sample rate
+            fs_out:    sample rate of the output
+            band:      instead of fs_out, the highest frequency to keep.
+                       See Resampler.
+            quality:   length of the filter.  See Resampler.
+
+        Returns
+        -------
+            (y, fs_out)
+                y:         the resampled waveform, of length
+                           ceil(n_samples*up/down) along the last axis
+                fs_out:    its sample rate, to pass on as fs to the
+                           transforms
+    """
+
+    resampler = Resampler(fs, fs_out, band, quality)
+    y = np.concatenate([resampler.process(x), resampler.flush()], axis=-1)
+
+    return y, resampler.fs_out
+
+
+@lru_cache(maxsize=16)
+def _lowpass(up, down, quality):
+    # The polyphase filter for resampling by up/down: a Kaiser windowed
+    # sinc, with its cutoff at the lower of the two Nyquist frequencies
+    # and gain up, and its half length rounded up to a multiple of down
+    # so that its delay is a whole number (returned) of output samples.
+
+    n = max(up, down)
+    half = quality * n
+    half += -half % down
+    cutoff = 1. / n
+
+    k = np.arange(-half, half + 1)
+    h = up * cutoff * np.sinc(cutoff * k) * np.kaiser(2 * half + 1, 5.)
+    h.setflags(write=False)
+
+    return h, half // down
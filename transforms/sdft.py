@@ -0,0 +1,173 @@
+# Author: Dan Valente
+
+from functools import lru_cache
+
+import numpy as np
+from pythagoras.utils import utils, fft_backend, instrument
+
+# The tapers that are sums of cosines, w[m] = sum_j (-1)**j a[j]
+# cos(2 pi j m / (N - 1)), as computed by get_taper
+_cosine_tapers = {'rect': (1.,),
+                  'hanning': (0.5, 0.5),
+                  'hamming': (0.54, 0.46),
+                  'blackman': (0.42, 0.5, 0.08),
+                  }
+
+
+@instrument.timed('sdft')
+def sdft(x, frame_size, step_size, nfft, taper_name='rect', one_sided=False,
+         bins=None, resync=None, dtype=None):
+    # Sliding DFT: the STFT of x (as from stft) at the bins given, from
+    # a recursive update between neighbouring frames rather than an FFT
+    # per frame.  x may be a stack of signals (..., n_samples), whose
+    # blocks of frames go through the same products together.
+    #
+    # For a rectangular window the spectrum at frequency f of the frame
+    # starting at sample n, R_n = sum_m x[n+m] exp(-2j pi f m), obeys
+    #
+    #     R_{n+1} = z (R_n + x[n+N] z**-N - x[n]),   z = exp(2j pi f)
+    #
+    # so that R_{n0+i} = z**i (R_{n0} + sum_{i'<i} d_{i'} z**-i'), with
+    # d the bracketed update.  The sum is a cumulative sum, which is
+    # computed for all frames at once; the terms of the hops between
+    # frames are summed with one matrix product.  A cosine taper is a
+    # sum of shifted complex exponentials, so the tapered spectrum is a
+    # combination of the spectra at f and f +- j/(N-1).  R_{n0} is
+    # computed exactly every resync frames (from FFTs of the frame
+    # modulated by exp(-+2j pi j m/(N-1))), which bounds the rounding
+    # error of the cumulative sums.
+
+    if taper_name not in _cosine_tapers:
+        raise ValueError("The sliding DFT supports the tapers: %s"
+                         % ', '.join(sorted(_cosine_tapers)))
+
+    N = frame_size
+    x = np.asarray(x)
+    n_samples = x.shape[-1]
+    n_frames = len(range(0, n_samples - N, step_size))
+    if bins is None:
+        bins = np.arange(nfft//2 + 1 if one_sided else nfft)
+    bins = tuple(int(k) for k in np.atleast_1d(bins))
+
+    n_freqs = len(bins) * (2 * len(_cosine_tapers[taper_name]) - 1)
+    if resync is None:
+        # Resync about once a frame length, but keep the tables and the
+        # spectra of a block to about 2**20 values
+        resync = max(1, min(-(-N // step_size), 2**20 // n_freqs))
+
+    weights, modulation, Zr, Zk = _tables(N, nfft, taper_name, bins,
+                                          one_sided, step_size, resync)
+
+    # One row per signal, zero padded so that every block of resync
+    # frames is complete
+    n_blocks = -(-n_frames // resync)
+    span = resync * step_size
+    rows = x.reshape(-1, n_samples)
+    n_rows = len(rows)
+    xpad = np.zeros((n_rows, n_blocks * span + N),
+                    dtype=np.result_type(x, float))
+    n = min(n_samples, xpad.shape[1])
+    xpad[:, :n] = rows[:, :n]
+
+    S = np.empty((n_rows, len(bins), n_blocks * resync),
+                 dtype=np.result_type(dtype, np.complex64))
+
+    # Blocks of frames in chunks of about 2**20 values per array
+    chunk = max(1, 2**20 // (resync * n_freqs * max(n_rows, 1)))
+    for b in range(0, n_blocks, chunk):
+        nb = min(chunk, n_blocks - b)
+        start = b * span
+        R = _block_spectra(xpad[:, start:start + nb * span + N], nb, N,
+                           nfft, bins, step_size, resync, modulation, Zr, Zk)
+        with instrument.stage('taper') as s:
+            R = R.reshape(n_rows, nb * resync, len(weights), len(bins))
+            S[..., b * resync:(b + nb) * resync] = s.output(
+                np.einsum('rnkb,k->rbn', R, weights))
+
+    return S[..., :n_frames].reshape(x.shape[:-1] + (len(bins), n_frames))
+
+
+def _block_spectra(x, nb, N, nfft, bins, step_size, resync, modulation, Zr,
+                   Zk):
+    # Spectra R (n_rows, nb, resync, n_freqs) of the frames of nb
+    # consecutive blocks of resync frames, of each row of x (one signal
+    # per row), x starting at the first of them
+
+    span = resync * step_size
+    n_rows = x.shape[0]
+
+    # Exact spectra of the first frame of every block: the spectrum at
+    # the bins shifted by s is the spectrum of the frame modulated by
+    # exp(-2j pi s m), so one FFT per shift gives them all
+    with instrument.stage('resync') as s:
+        first = np.lib.stride_tricks.as_strided(
+            x, (n_rows, nb, N),
+            (x.strides[0], span * x.strides[1], x.strides[1]))
+        spectra = fft_backend.fft(first[..., np.newaxis, :] * modulation,
+                                  nfft, axis=-1)
+        R0 = s.output(spectra[..., list(bins)].reshape(n_rows, nb, -1))
+
+    # The updates d_i z**-i summed over each hop: d = x[n+N] z**-N -
+    # x[n], so both terms come from one product with [z**-(N+r); -z**-r]
+    with instrument.stage('update') as s:
+        old = x[:, :nb * span].reshape(n_rows, nb, resync, step_size)
+        new = x[:, N:N + nb * span].reshape(n_rows, nb, resync, step_size)
+        hops = np.concatenate([new, old], axis=-1)[:, :, :-1]
+
+        # R_k z**-(k step) is R0 plus the sum of the earlier hops' H, so
+        # a cumulative sum over [R0, H_0, ..., H_{resync-2}] gives it
+        R = np.empty((n_rows, nb, resync, Zr.shape[1]), dtype=complex)
+        R[:, :, 0] = R0
+        np.matmul(hops, Zr, out=R[:, :, 1:])
+        R[:, :, 1:] *= Zk[:-1]
+        np.cumsum(R, axis=2, out=R)
+        R *= Zk.conj()
+
+        return s.output(R)
+
+
+@lru_cache(maxsize=16)
+def _tables(N, nfft, taper_name, bins, one_sided, step_size, resync):
+    # The tables of the recursion, for the frequencies (in cycles per
+    # sample) whose rectangular window spectra are tracked: the bins,
+    # and for a cosine taper the bins shifted by +-j/(N-1), one row of
+    # len(bins) frequencies per shift.
+    #     weights:     the combination of the rows that gives the
+    #                  tapered spectra, scaled as by tfft's normalized
+    #                  taper
+    #     modulation:  exp(-2j pi shift m), m < N, for each shift, for
+    #                  the exact spectra
+    #     Zr:          [z**-(N+r); -z**-r], r < step_size, the terms
+    #                  of the updates within a hop
+    #     Zk:          z**-(k step_size), k < resync, at each frame of
+    #                  a block
+
+    a = _cosine_tapers[taper_name]
+    f = np.array(bins) / float(nfft)
+    L = max(N - 1, 1)
+
+    shifts = [0.]
+    weights = [a[0]]
+    for j in range(1, len(a)):
+        # cos(2 pi j m/L) = (exp(2j pi j m/L) + exp(-2j pi j m/L))/2,
+        # and a positive exponent shifts the spectrum down
+        for shift in (-j / float(L), j / float(L)):
+            shifts.append(shift)
+            weights.append((-1) ** j * a[j] / 2.)
+
+    scale = (2. if one_sided else 1.) / utils.get_taper(taper_name, N).sum()
+    weights = scale * np.array(weights)
+    shifts = np.array(shifts)
+    freqs = (shifts[:, np.newaxis] + f).reshape(-1)
+
+    def z(power):
+        return np.exp(-2j * np.pi * np.outer(power, freqs))
+
+    modulation = np.exp(-2j * np.pi * np.outer(shifts, np.arange(N)))
+    r = np.arange(step_size)
+    tables = (weights, modulation, np.concatenate([z(N + r), -z(r)]),
+              z(np.arange(resync) * step_size))
+    for table in tables:
+        table.setflags(write=False)
+
+    return tables
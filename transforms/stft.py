@@ -2,20 +2,43 @@
 
 import numpy as np
 from pythagoras.transforms import tfft
-from pythagoras.utils import utils
+from pythagoras.transforms.sdft import sdft
+from pythagoras.utils import utils, instrument, cache
 
 
+@instrument.timed('stft')
+@cache.cached('stft')
 def stft(x, frame_size=None, step_size=None, fs=44100, nfft=None,
-         taper_name='rect', taper_param=None):
+         taper_name='rect', taper_param=None, one_sided=False, out=None,
+         block_frames=None, dtype=None, adaptive=False, method='fft',
+         bins=None, resync=None):
     """
          stft(x,frame_size=None,step_size=None,fs = 44100, nfft=None,
-             taper_name='rect',taper_param=None)
+             taper_name='rect',taper_param=None,one_sided=False,
+             out=None,block_frames=None,dtype=None,adaptive=False,
+             method='fft',bins=None,resync=None)
             Calculates the Short-time Fourier Transform of the input
-            signal x.
+            signal x.  With taper_name='mtm', calculates the multitaper
+            power spectrogram instead (see tfft).
+
+            With method='sdft' (sliding DFT), each frame's spectrum is
+            updated from the previous frame's in O(step_size) per bin,
+            rather than taking an O(nfft log nfft) FFT of every frame.
+            This pays off for small steps (1 to 16 samples) and for a
+            few tracked bins.  Every resync frames the spectra are
+            recomputed exactly, which keeps the rounding error below
+            about 1e-12 of the largest bin.  Only the cosine
+            tapers ('rect', 'hanning', 'hamming', 'blackman') are
+            supported, and the result is always computed in double
+            precision.
 
         Input
         -----
-            x:             the waveform to transform
+            x:             the waveform to transform, or several
+                           waveforms of the same length (e.g. the
+                           channels of a recording, or a batch of
+                           clips), size (..., n_samples).  All of them
+                           are framed and transformed in one call.
             frame_size:    the size of a frame in samples.  Defaults to
                            1/10 of sample rate.
             step_size:     the 'hop' or step size in samples to move the
@@ -31,10 +54,43 @@ def stft(x, frame_size=None, step_size=None, fs=44100, nfft=None,
                            options.
             taper_param:   parameter for taper. See utils.get_taper for
                            options
+            one_sided:     if True, only the nfft/2+1 non-negative
+                           frequency bins are computed, as in
+                           tfft(one_sided=True).
+            out:           if given, S is written to out a block of
+                           frames at a time instead of being built in
+                           memory.  Either the name of a .npy file to
+                           create (as a memory map, in Fortran order so
+                           that blocks of frames are contiguous on
+                           disk), or an array or np.memmap of the right
+                           size.  Together with utils.mmap_wav, this
+                           allows spectrograms larger than memory.
+            block_frames:  number of frames per block when out is
+                           given. Default is about 64 MB per block.
+            dtype:         float dtype to compute in, e.g. np.float32
+                           for a complex64 result.  See tfft.
+            adaptive:      for 'mtm', if True, Thomson's adaptive
+                           weighting of the tapers.  See tfft.
+            method:        'fft' (default), or 'sdft' for the sliding
+                           DFT
+            bins:          indices of the frequency bins to compute
+                           (e.g. those of a tracked partial).  Default
+                           is all of them.  With 'fft', the other bins
+                           are computed and dropped.
+            resync:        for 'sdft', the number of frames between
+                           exact recomputations.  Default is about one
+                           frame length's worth of steps, fewer if the
+                           tables would exceed 2**20 values.
         Returns
         -------
             (S,freq,time)
-                S:         short-time Fourier transform
+                S:         short-time Fourier transform, size
+                           (nfft, n_frames), or (nfft/2+1, n_frames)
+                           if one_sided, or (len(bins), n_frames).
+                           For x of size (..., n_samples), size
+                           (..., nfft, n_frames) and so on.
+                           For 'mtm', the real power spectrogram of the
+                           same size.  If out is given, this is out.
                 freq:      frequency bins (in Hz)
                 time:      time bins (in s)
     """
@@ -47,18 +103,83 @@ def stft(x, frame_size=None, step_size=None, fs=44100, nfft=None,
     if step_size is None:
         step_size = np.fix(frame_size/2)
 
+    step_size = int(step_size)
+
     if step_size >= frame_size:
         raise
 
     if nfft is None:
         nfft = int(utils.nextpow2(frame_size))
 
-    X = [tfft(x[i:i+frame_size], nfft, taper_name, taper_param)
-         for i in range(0, len(x) - frame_size, step_size)]
-    S = np.array(X)
-    S = S.T
+    x = np.asarray(x)
+    n_samples = x.shape[-1]
+
+    if method not in ('fft', 'sdft'):
+        raise ValueError("Unknown method '%s'. Choices are: fft, sdft"
+                         % method)
+
+    if bins is None:
+        rows = slice(None)
+    else:
+        rows = np.atleast_1d(bins)
+
+    if method == 'sdft':
+        S = sdft(x, frame_size, step_size, nfft, taper_name, one_sided, bins,
+                 resync, dtype)
+        if out is not None:
+            S_out = utils.output_array(out, S.shape, S.dtype)
+            S_out[:] = S
+            S = S_out
+    elif out is None:
+        # All frames are tapered and transformed in one batched call on
+        # a strided view of x, rather than one tfft call per frame.
+        frames = utils.frame(x, frame_size, step_size)
+        S = tfft(frames, nfft, taper_name, taper_param, one_sided,
+                 dtype, adaptive)
+        S = np.swapaxes(S, -1, -2)[..., rows, :]
+    else:
+        nbins = nfft//2 + 1 if one_sided else nfft
+        if bins is not None:
+            nbins = len(rows)
+        n_frames = len(range(0, n_samples - frame_size, step_size))
+        kind = np.float32 if taper_name == 'mtm' else np.complex64
+        S = utils.output_array(out, x.shape[:-1] + (nbins, n_frames),
+                               np.result_type(dtype, kind))
+        for i, S_block in _blocks(x, frame_size, step_size, nfft,
+                                  taper_name, taper_param, one_sided,
+                                  block_frames, dtype, adaptive):
+            S[..., i:i + S_block.shape[-1]] = S_block[..., rows, :]
+    if hasattr(S, 'flush'):
+        S.flush()
 
-    freq = np.linspace(0, fs, nfft)
-    time = np.linspace(0, len(x)/fs, len(x))
+    if one_sided:
+        freq = np.linspace(0, fs/2, nfft//2 + 1)
+    else:
+        freq = np.linspace(0, fs, nfft)
+    freq = freq[rows]
+    time = np.linspace(0, n_samples/fs, n_samples)
 
     return S, freq, time
+
+
+def _blocks(x, frame_size, step_size, nfft, taper_name, taper_param,
+            one_sided, block_frames=None, dtype=None, adaptive=False):
+    # Yields (first frame, STFT of a block of frames), so that only one
+    # block is in memory at a time.  For several signals, each block has
+    # the same frames of all of them.
+
+    frames = utils.frame(x, frame_size, step_size)
+
+    if block_frames is None:
+        nbins = nfft//2 + 1 if one_sided else nfft
+        n_signals = int(np.prod(frames.shape[:-2]))
+        block_frames = max(1, 2**22 // (nbins * max(n_signals, 1)))
+        if taper_name == 'mtm':
+            # Every taper of every frame is transformed at once
+            K = utils._mtm_params(taper_param)[1]
+            block_frames = max(1, block_frames // K)
+
+    for i in range(0, frames.shape[-2], block_frames):
+        S = tfft(frames[..., i:i + block_frames, :], nfft, taper_name,
+                 taper_param, one_sided, dtype, adaptive)
+        yield i, np.swapaxes(S, -1, -2)
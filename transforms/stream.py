@@ -0,0 +1,242 @@
+# Author: Dan Valente
+
+import numpy as np
+from pythagoras.transforms import tfft
+from pythagoras.transforms.istft import (_synthesis_frames, _overlap_add,
+                                         _normalize)
+from pythagoras.utils import utils, instrument
+
+
+class StreamSTFT(object):
+    """
+        StreamSTFT(frame_size=None, step_size=None, fs=44100, nfft=None,
+                   taper_name='rect', taper_param=None, one_sided=False,
+                   dtype=None)
+            Short-time Fourier Transform of an unbounded signal that
+            arrives in chunks.  Each call to process() returns the
+            frames that were completed by the new samples, and the
+            unused tail of the signal is carried over to the next call,
+            so memory use is bounded by one frame plus one chunk.
+
+            Concatenating the outputs of process() along the frame axis
+            gives the same result as stft on the concatenated input.
+            Chunks of several signals, size (..., n_samples), are
+            streamed together in the same way.
+
+        Input
+        -----
+            See stft.  The defaults for frame_size, step_size and nfft
+            are the same.
+
+        Example
+        -------
+            analyzer = StreamSTFT(frame_size=1024, step_size=256)
+            for chunk in chunks:
+                S = analyzer.process(chunk)  # (nfft, n_new_frames)
+    """
+
+    def __init__(self, frame_size=None, step_size=None, fs=44100, nfft=None,
+                 taper_name='rect', taper_param=None, one_sided=False,
+                 dtype=None):
+
+        if frame_size is None:
+            frame_size = int(fs/10)
+
+        frame_size = int(frame_size)
+
+        if step_size is None:
+            step_size = np.fix(frame_size/2)
+
+        step_size = int(step_size)
+
+        if step_size >= frame_size:
+            raise ValueError("step_size must be smaller than frame_size")
+
+        if nfft is None:
+            nfft = int(utils.nextpow2(frame_size))
+
+        self.frame_size = frame_size
+        self.step_size = step_size
+        self.fs = fs
+        self.nfft = nfft
+        self.taper_name = taper_name
+        self.taper_param = taper_param
+        self.one_sided = one_sided
+        self.dtype = dtype
+        self.reset()
+
+    def reset(self):
+        """
+            reset()
+                Discards any buffered samples and starts a new stream.
+        """
+        self._buffer = None
+        self.n_frames = 0
+
+    @instrument.timed('stream_stft')
+    def process(self, x):
+        """
+            process(x)
+                Adds the chunk x to the stream.
+
+            Input
+            -----
+                x:    the next samples of the waveform (any length), or
+                      of several, size (..., n_samples)
+
+            Returns
+            -------
+                S:    STFT of the frames completed by x, size
+                      (..., nfft, n_new_frames), or
+                      (..., nfft/2+1, n_new_frames) if one_sided.
+                      n_new_frames may be 0.
+        """
+
+        # The buffer always starts at the beginning of the next frame
+        x = np.asarray(x, self.dtype)
+        if self._buffer is None:
+            buf = x
+        else:
+            buf = np.concatenate([self._buffer, x], axis=-1)
+
+        frames = utils.frame(buf, self.frame_size, self.step_size)
+        S = tfft(frames, self.nfft, self.taper_name, self.taper_param,
+                 self.one_sided, self.dtype)
+
+        n = frames.shape[-2]
+        self._buffer = buf[..., n * self.step_size:].copy()
+        self.n_frames += n
+
+        return np.swapaxes(S, -1, -2)
+
+
+class StreamISTFT(object):
+    """
+        StreamISTFT(frame_size=None, step_size=None, fs=44100, nfft=None,
+                    taper_name='rect', taper_param=None, one_sided=False,
+                    dtype=None)
+            Weighted overlap-add synthesis for an unbounded stream of
+            STFT frames, as produced by StreamSTFT.  Each call to
+            process() returns the samples that no later frame can
+            change, and the overlapping tail (and its window-sum
+            envelope) is carried over to the next call, so memory use
+            is bounded by one frame plus one block of frames.  flush()
+            returns the final tail.
+
+            Concatenating the outputs of process() and flush() gives
+            the same result as istft on the concatenated frames (up to
+            rounding).
+
+        Input
+        -----
+            See istft.  The arguments should match those given to
+            StreamSTFT (or stft).  With dtype=np.float32 the synthesis
+            runs, and the output is, in single precision.
+    """
+
+    def __init__(self, frame_size=None, step_size=None, fs=44100, nfft=None,
+                 taper_name='rect', taper_param=None, one_sided=False,
+                 dtype=None):
+
+        if frame_size is None:
+            frame_size = int(fs/10)
+
+        frame_size = int(frame_size)
+
+        if step_size is None:
+            step_size = np.fix(frame_size/2)
+
+        step_size = int(step_size)
+
+        if step_size >= frame_size:
+            raise ValueError("step_size must be smaller than frame_size")
+
+        self.frame_size = frame_size
+        self.step_size = step_size
+        self.fs = fs
+        self.nfft = nfft
+        self.one_sided = one_sided
+        self._w = utils.normalized_taper(taper_name, frame_size, taper_param,
+                                         None if dtype is None
+                                         else np.dtype(dtype))
+        self.reset()
+
+    def reset(self):
+        """
+            reset()
+                Discards any buffered samples and starts a new stream.
+        """
+        self._tail = np.zeros(0, dtype=self._w.dtype)
+        self._env_tail = np.zeros(0, dtype=self._w.dtype)
+        self.n_frames = 0
+
+    @instrument.timed('stream_istft')
+    def process(self, X):
+        """
+            process(X)
+                Adds a block of STFT frames to the stream.
+
+            Input
+            -----
+                X:    STFT frames, size (nfft, n_frames) (or
+                      (nfft/2+1, n_frames) if one_sided), or a stack
+                      of them, size (..., nfft, n_frames), that are
+                      synthesized together
+
+            Returns
+            -------
+                y:    the n_frames*step_size samples completed by X,
+                      size (..., n_frames*step_size) for a stack
+        """
+
+        X = np.asarray(X)
+        if X.ndim == 1:
+            X = X[:, np.newaxis]
+
+        if self.nfft is None:
+            if self.one_sided:
+                self.nfft = 2 * (X.shape[-2] - 1)
+            else:
+                self.nfft = X.shape[-2]
+
+        frames = _synthesis_frames(X, self.frame_size, self.nfft, self._w,
+                                   self.one_sided)
+        env_frames = np.broadcast_to(self._w ** 2, frames.shape[-2:])
+
+        n = frames.shape[-2]
+        done = n * self.step_size
+
+        y = _add_tail(_overlap_add(frames, self.step_size), self._tail)
+        env = _add_tail(_overlap_add(env_frames, self.step_size),
+                        self._env_tail)
+
+        self._tail = y[..., done:].copy()
+        self._env_tail = env[done:].copy()
+        self.n_frames += n
+
+        return _normalize(y[..., :done], env[:done])
+
+    def flush(self):
+        """
+            flush()
+                Returns the samples still overlapping the last frame and
+                resets the stream.
+        """
+        y = _normalize(self._tail, self._env_tail)
+        self.reset()
+
+        return y
+
+
+def _add_tail(y, tail):
+    # Adds the carried over tail to the start of y (along the last
+    # axis), growing y if needed
+
+    n = tail.shape[-1]
+    if n > y.shape[-1]:
+        pad = np.zeros(y.shape[:-1] + (n - y.shape[-1],), dtype=y.dtype)
+        y = np.concatenate([y, pad], axis=-1)
+    y[..., :n] += tail
+
+    return y
+
@@ -1,22 +1,38 @@
 # Author: Dan Valente
 
 import numpy as np
-from scipy.fftpack import fft
-from pythagoras.utils import utils
+from pythagoras.utils import utils, fft_backend, instrument
 
 
-def tfft(x, nfft=None, taper_name="rect", taper_param=None, one_sided=False):
+@instrument.timed('tfft')
+def tfft(x, nfft=None, taper_name="rect", taper_param=None, one_sided=False,
+         dtype=None, adaptive=False):
     """
         tfft(x,nfft=None,taper_name="rect",taper_param=None,
-             one_sided = False)
+             one_sided = False, dtype=None, adaptive=False)
             Tapered FFT.
-            This is basically a wrapper to scipy's fft, but allows
-            user to choose a specific taper to be applied. Taper
-            options can be found in utils.get_taper
+            This is basically a wrapper to the fft (see
+            utils.fft_backend), but allows user to choose a specific
+            taper to be applied. Taper options can be found in
+            utils.get_taper
+
+            With taper_name='mtm', the result is instead Thomson's
+            multitaper estimate of the power spectrum: x is multiplied
+            by all K DPSS tapers (see utils.dpss) in one broadcast, the
+            K tapered copies go through one batched FFT, and their
+            power spectra are averaged, weighted by the tapers'
+            concentration ratios (or adaptively).  The estimate is
+            scaled so that white noise of variance s2 has power s2 in
+            every bin.
 
         Input
         -----
-            x:             the waveform to transform
+            x:             the waveform to transform.  If x has more
+                           dimensions, size (..., N), it is transformed
+                           along the last axis (e.g. the frames from
+                           utils.frame, or the channels of a
+                           recording), with one taper broadcast across
+                           the rest and a single batched FFT.
             nfft:          number of points in the fft.  If none
                            given, the next largest power of 2 larger
                            than len(x) is used.
@@ -24,26 +40,205 @@ def tfft(x, nfft=None, taper_name="rect", taper_param=None, one_sided=False):
                            rectangular ('rect'). See utils.get_taper for
                            options.
             taper_param:   parameter for taper. See utils.get_taper for
-                           options
-            one_sided:     if True, yields the one-sided fourier transform
+                           options.  For 'mtm', NW or (NW, K); default
+                           NW=4 and K=7.
+            one_sided:     if True, yields the one-sided fourier transform.
+                           Only the nfft/2+1 non-negative frequency bins
+                           are computed (real-input FFT), so x must be
+                           real.  For 'mtm', the one-sided power
+                           spectrum (doubled, except at 0 and nfft/2).
+            dtype:         float dtype to compute in, e.g. np.float32.
+                           The taper and tapered signal are cast to it
+                           (a frame at a time, never the whole signal)
+                           and the FFT keeps that precision, so float32
+                           gives a complex64 result at half the memory.
+                           Default (None) is float64.
+
+                           In float32, the error in each transformed
+                           frame, relative to its norm, is a few times
+                           eps*log2(nfft) (eps = 1.2e-7), i.e. about
+                           1e-6 for nfft up to 2**16. The same bound
+                           holds for stft, and for cqt, mfcc and ceps
+                           relative to the float64 results.
+            adaptive:      for 'mtm' only: if True, the tapers are
+                           weighted in each bin by Thomson's adaptive
+                           weights, which reduce the broadband leakage
+                           of the higher order tapers where the
+                           spectrum has a large dynamic range
 
         Returns
         -------
-            X:            one, or two sided tapered, fast Fourier transform
+            X:            one, or two sided tapered, fast Fourier
+                          transform, size (..., nfft), or
+                          (..., nfft/2+1) if one_sided.  For 'mtm', the
+                          (real) multitaper power spectrum.
+
+        [REF]
+        Thomson DJ (1982). Spectrum estimation and harmonic analysis.
+        Proc. IEEE 70(9):1055-1096
+
+        Percival DB and Walden AT (1993). Spectral Analysis for
+        Physical Applications. Cambridge University Press, ch. 7
     """
 
     #TODO: Check magnitude on one-sided spectrum
 
+    N = np.shape(x)[-1]
+
     if nfft is None:
-        nfft = int(utils.nextpow2(len(x)))
+        nfft = int(utils.nextpow2(N))
+
+    if dtype is not None:
+        dtype = np.dtype(dtype)
+
+    if taper_name == 'mtm':
+        return _multitaper(x, nfft, taper_param, one_sided, dtype, adaptive)
+
+    w = utils.normalized_taper(taper_name, N, taper_param, dtype)
+
+    if dtype is not None and np.iscomplexobj(x):
+        dtype = np.result_type(dtype, np.complex64)
+
+    # Many rows (the frames of a long signal, or of a stack of signals)
+    # are tapered and transformed a block at a time, so that the
+    # tapered copy never takes more than a block's memory
+    x = np.asarray(x)
+    n_rows = int(np.prod(x.shape[:-1]))
+    block = max(1, 2**18 // nfft)
+    if n_rows <= block:
+        return _tapered_fft(x, w, nfft, one_sided, dtype)
 
-    taper = utils.get_taper(taper_name, len(x), taper_param)
+    X = None
+    for i in range(0, n_rows, block):
+        X_block = _tapered_fft(_rows(x, i, block), w, nfft, one_sided,
+                               dtype)
+        if X is None:
+            X = np.empty((n_rows, X_block.shape[-1]), dtype=X_block.dtype)
+        X[i:i + block] = X_block
 
-    w = taper / sum(taper)
+    return X.reshape(x.shape[:-1] + X.shape[-1:])
 
-    X = fft(np.multiply(w, x), nfft)
+
+def _rows(x, start, n):
+    # Rows start to start+n of x (..., N), counting over all its leading
+    # axes, size (n, N).  Only those rows are copied: x may be a strided
+    # view (e.g. overlapping frames) that reshaping would expand whole.
+
+    if x.ndim <= 2:
+        return x.reshape(-1, x.shape[-1])[start:start + n]
+
+    n_rows = int(np.prod(x.shape[:-1]))
+    index = np.arange(start, min(start + n, n_rows))
+
+    return x[np.unravel_index(index, x.shape[:-1])]
+
+
+def _tapered_fft(x, w, nfft, one_sided, dtype):
+    # The FFT of x times the taper w, along the last axis
+
+    with instrument.stage('window') as s:
+        xw = s.output(np.multiply(w, x, dtype=dtype))
 
     if one_sided:
-        return 2*X[:nfft/2+1]
-    else:
+        X = fft_backend.rfft(xw, nfft, axis=-1)
+        X *= 2
         return X
+    else:
+        return fft_backend.fft(xw, nfft, axis=-1)
+
+
+def _multitaper(x, nfft, taper_param, one_sided, dtype, adaptive):
+    # Multitaper power spectrum of x (or of each row of x).  The K
+    # tapered copies of a frame take K times its memory, so the rows
+    # go through a block at a time, sized to stay in cache.
+
+    x = np.asarray(x)
+    N = x.shape[-1]
+    tapers, ratios = utils.dpss(N, *utils._mtm_params(taper_param),
+                                dtype=dtype)
+    K = len(tapers)
+
+    if dtype is not None and np.iscomplexobj(x):
+        dtype = np.result_type(dtype, np.complex64)
+
+    n_rows = int(np.prod(x.shape[:-1]))
+    n_bins = nfft//2 + 1 if one_sided else nfft
+    real = np.float32 if dtype in (np.float32, np.complex64) else float
+    S = np.empty((n_rows, n_bins), dtype=real)
+
+    block = max(1, 2**20 // (K * nfft))
+    for i in range(0, n_rows, block):
+        frames = _rows(x, i, block)
+
+        # (n, K, N): every taper applied to every frame in one broadcast
+        with instrument.stage('window') as s:
+            xw = s.output(np.multiply(tapers, frames[:, np.newaxis, :],
+                                      dtype=dtype))
+
+        if one_sided:
+            Y = fft_backend.rfft(xw, nfft, axis=-1)
+        else:
+            Y = fft_backend.fft(xw, nfft, axis=-1)
+
+        with instrument.stage('multitaper') as s:
+            P = Y.real ** 2 + Y.imag ** 2
+            if adaptive:
+                S[i:i + block] = _adaptive(P, ratios, np.var(frames, axis=-1))
+            else:
+                weights = (ratios / ratios.sum()).astype(P.dtype)
+                S[i:i + block] = np.einsum('k,nkf->nf', weights, P)
+            s.output(P)
+
+    if one_sided:
+        S[:, 1:(nfft + 1)//2] *= 2
+
+    return S.reshape(x.shape[:-1] + (n_bins,))
+
+
+def _adaptive(P, ratios, variance, max_iter=100, tol=1e-6):
+    # Thomson's adaptive weighting of the eigenspectra P (..., K, n_bins)
+    # (Percival & Walden 1993, eq. 370a).  The weight of taper k in a
+    # bin is d_k**2 = l_k S**2 / (l_k S + (1 - l_k) s2)**2, with l_k
+    # its concentration ratio, s2 the variance of the signal and S the
+    # estimate, so that is iterated from the mean of the first two
+    # eigenspectra.  Bins are updated together, each until it changes
+    # by no more than tol (relative).  Most converge in a few
+    # iterations, so once half have, only those still changing are
+    # carried on.
+
+    tiny = np.finfo(P.dtype).tiny
+    K, n_bins = P.shape[-2:]
+    lead = P.shape[:-2]
+    lam = ratios.astype(P.dtype)[:, np.newaxis]
+
+    # A column of K eigenspectra per (frame, bin), so that the sums over
+    # the tapers add K contiguous rows
+    Pk = np.moveaxis(P, -2, 0).reshape(K, -1)
+    s2 = np.broadcast_to(np.asarray(variance, dtype=P.dtype)[..., np.newaxis],
+                         lead + (n_bins,)).reshape(-1)
+    leak = (1 - lam) * s2
+
+    S = Pk[:2].mean(axis=0)
+    index = np.arange(len(S))
+    Sa = S.copy()
+    for i in range(max_iter):
+        d2 = lam * Sa
+        d2 += leak
+        d2 *= d2
+        np.maximum(d2, tiny, out=d2)
+        np.divide(lam * Sa ** 2, d2, out=d2)
+        S_new = (d2 * Pk).sum(axis=0)
+        S_new /= np.maximum(d2.sum(axis=0), tiny)
+
+        changing = np.abs(S_new - Sa) > tol * S_new
+        S[index] = S_new
+        n_changing = np.count_nonzero(changing)
+        if n_changing == 0:
+            break
+        Sa = S_new
+        if n_changing < len(changing) // 2:
+            # Only the bins still changing are carried on
+            index, Sa = index[changing], Sa[changing]
+            Pk, leak = Pk[:, changing], leak[:, changing]
+
+    return S.reshape(lead + (n_bins,))
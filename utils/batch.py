@@ -0,0 +1,230 @@
+'''
+Author: Dan Valente
+
+Batch feature extraction over a corpus of WAV files.
+
+Files are spread over a pool of worker processes.  Each worker builds
+its FeaturePlan (and so its tapers, mel banks and constant-Q kernels)
+once per sample rate and reuses it for every file it is given, and
+writes each file's features to disk as soon as they are computed.  A
+file that fails to load or transform is reported and skipped without
+stopping the rest of the batch.
+
+From the command line:
+
+    python -m pythagoras.utils.batch data/ -o features/ -j 8 \
+        --spec '{"frame_size": 1024, "step_size": 256,
+                 "features": {"mfcc": {"n_coeffs": 13}, "stft": {}}}'
+'''
+
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+import traceback
+
+import numpy as np
+from pythagoras.transforms import FeaturePlan
+from pythagoras.utils import utils, fft_backend
+
+# Per worker state, set up by _init_worker
+_worker = {}
+
+
+def extract(files, spec, out_dir, n_jobs=None, chunksize=None,
+            progress=True):
+    """
+        extract(files, spec, out_dir, n_jobs=None, chunksize=None,
+                progress=True)
+            Computes the features in spec for every WAV file and saves
+            them to out_dir, one .npz file per input file (holding one
+            array per feature, plus fs).  Outputs mirror the layout of
+            the input files below their common directory.
+
+        Input
+        -----
+            files:       a list of WAV files, or a directory, which is
+                         searched recursively for .wav files
+            spec:        dict of FeaturePlan arguments (fs is taken
+                         from each file) with a 'features' entry
+                         mapping each feature name to a dict of its
+                         options.  The kind of feature is the name,
+                         unless given with a 'kind' option.  E.g.
+                             {'frame_size': 1024, 'step_size': 256,
+                              'features': {'mfcc': {'n_coeffs': 13},
+                                           'ceps_h': {'kind': 'ceps',
+                                               'taper_name': 'hanning'}}}
+            out_dir:     directory to write the features to
+            n_jobs:      number of worker processes. Default is the
+                         number of cores.
+            chunksize:   number of files handed to a worker at a time.
+                         Default is to give each worker about four
+                         chunks.
+            progress:    if True, prints a line per finished file to
+                         stderr.  A function f(n_done, n_total, record)
+                         can be given instead.
+
+        Returns
+        -------
+            list of (wav file, output file, error) tuples, in order of
+            completion.  For failed files the output file is None and
+            error holds the traceback; otherwise error is None.
+    """
+
+    # Fails on a malformed spec here, once, rather than in every worker
+    make_plan(spec, 44100)
+
+    if isinstance(files, str):
+        files = find_wavs(files)
+
+    files = list(files)
+    if not files:
+        return []
+
+    if n_jobs is None:
+        n_jobs = multiprocessing.cpu_count()
+
+    if chunksize is None:
+        chunksize = max(1, len(files) // (4 * n_jobs))
+
+    if progress is True:
+        progress = _print_progress
+
+    root = os.path.commonpath([os.path.dirname(os.path.abspath(f))
+                               for f in files])
+    tasks = [(f, _out_file(f, root, out_dir)) for f in files]
+
+    results = []
+    pool = multiprocessing.Pool(n_jobs, initializer=_init_worker,
+                                initargs=(spec,))
+    try:
+        for record in pool.imap_unordered(_extract_one, tasks, chunksize):
+            results.append(record)
+            if progress:
+                progress(len(results), len(tasks), record)
+    finally:
+        pool.close()
+        pool.join()
+
+    return results
+
+
+def find_wavs(directory):
+    """
+        find_wavs(directory)
+            Lists the .wav files below directory, in sorted order.
+    """
+
+    found = []
+    for path, dirs, names in os.walk(directory):
+        found.extend(os.path.join(path, name) for name in names
+                     if name.lower().endswith('.wav'))
+
+    return sorted(found)
+
+
+def make_plan(spec, fs):
+    """
+        make_plan(spec, fs)
+            Builds the FeaturePlan described by spec (see extract) for
+            sample rate fs.
+    """
+
+    spec = dict(spec)
+    features = spec.pop('features')
+    plan = FeaturePlan(fs=fs, **spec)
+    for name, params in features.items():
+        params = dict(params)
+        kind = params.pop('kind', name)
+        plan.add(kind, name, **params)
+
+    return plan
+
+
+def _out_file(wav_file, root, out_dir):
+    rel = os.path.relpath(os.path.abspath(wav_file), root)
+
+    return os.path.join(out_dir, os.path.splitext(rel)[0] + '.npz')
+
+
+def _init_worker(spec):
+    # Each process gets a share of the cores already, so the FFTs in
+    # a worker should not start threads of their own.
+    fft_backend.set_backend(fft_backend.get_backend()[0], workers=1)
+    _worker['spec'] = spec
+    _worker['plans'] = {}
+
+
+def _extract_one(task):
+    wav_file, out_file = task
+    try:
+        x, fs = utils.read_wav(wav_file)
+
+        plans = _worker['plans']
+        if fs not in plans:
+            plans[fs] = make_plan(_worker['spec'], fs)
+        features = plans[fs].run(x)
+
+        out_path = os.path.dirname(out_file)
+        if out_path:
+            os.makedirs(out_path, exist_ok=True)
+        np.savez(out_file, fs=fs, **features)
+    except Exception:
+        return wav_file, None, traceback.format_exc()
+
+    return wav_file, out_file, None
+
+
+def _print_progress(n_done, n_total, record):
+    wav_file, out_file, error = record
+    if error is None:
+        sys.stderr.write('[%d/%d] %s\n' % (n_done, n_total, wav_file))
+    else:
+        last = error.strip().splitlines()[-1]
+        sys.stderr.write('[%d/%d] %s FAILED: %s\n'
+                         % (n_done, n_total, wav_file, last))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='python -m pythagoras.utils.batch',
+        description='Extract features from a corpus of WAV files.')
+    parser.add_argument('inputs', nargs='+',
+                        help='WAV files or directories of WAV files')
+    parser.add_argument('-o', '--out-dir', required=True,
+                        help='directory to write .npz features to')
+    parser.add_argument('-s', '--spec', required=True,
+                        help='feature spec, as JSON or a JSON file')
+    parser.add_argument('-j', '--jobs', type=int, default=None,
+                        help='number of worker processes')
+    parser.add_argument('--chunksize', type=int, default=None,
+                        help='files handed to a worker at a time')
+    parser.add_argument('-q', '--quiet', action='store_true',
+                        help='do not report progress')
+    args = parser.parse_args(argv)
+
+    if os.path.isfile(args.spec):
+        with open(args.spec) as f:
+            spec = json.load(f)
+    else:
+        spec = json.loads(args.spec)
+
+    files = []
+    for path in args.inputs:
+        if os.path.isdir(path):
+            files.extend(find_wavs(path))
+        else:
+            files.append(path)
+
+    results = extract(files, spec, args.out_dir, args.jobs, args.chunksize,
+                      progress=not args.quiet)
+
+    failed = [r for r in results if r[2] is not None]
+    sys.stderr.write('%d files, %d failed\n' % (len(results), len(failed)))
+
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,324 @@
+'''
+Author: Dan Valente
+
+Opt-in, content-addressed disk cache for the results of the public
+transforms (stft, cqt, mfcc and ceps).  A result is keyed on a hash of
+the input samples and of every argument of the call (including the
+defaults that were not given), the library version and the FFT backend
+(see fft_backend), so the same audio analyzed with the same settings
+is only computed once, across runs and processes.  block_frames, which
+only changes how a result is computed, is left out of the key.
+Results are stored as .npy files, and a cache hit maps them back
+(copy-on-write) without reading them into memory: the arrays can be
+modified like computed ones, and changes are never written to the
+cache.
+
+Nothing is cached (and the cost is one check per call) until a cache
+directory is set:
+
+    from pythagoras.utils import cache
+
+    cache.set_cache('/tmp/pythagoras-cache', max_bytes=2**32)
+    S, freq, time = stft(x, 2048, 512)   # computed and stored
+    S, freq, time = stft(x, 2048, 512)   # mapped from disk
+    cache.stats()                        # {'hits': 1, 'misses': 1, ...}
+
+    with cache.use('/scratch/cache'):
+        C = cqt(x)
+
+When the files of the cache exceed max_bytes, the least recently used
+results are deleted.  Calls that write to an out array, and transforms
+called from inside another cached transform (e.g. the stft inside
+mfcc), are not cached.
+'''
+
+from contextlib import contextmanager
+from functools import wraps
+import hashlib
+import inspect
+import os
+import shutil
+import tempfile
+import threading
+
+import numpy as np
+from pythagoras import __version__
+from pythagoras.utils import instrument, fft_backend
+
+# directory is None while caching is off
+_state = {'directory': None, 'max_bytes': 2**30}
+_stats = {'hits': 0, 'misses': 0, 'stores': 0, 'evictions': 0}
+_local = threading.local()
+
+# Arguments that do not change the result, so are not part of the key
+_unkeyed = ('block_frames',)
+
+
+def set_cache(directory, max_bytes=2**30):
+    """
+        set_cache(directory, max_bytes=2**30)
+            Turns caching on, in directory (which is created if
+            needed), or off if directory is None.
+
+        Input
+        -----
+            directory:  where results are stored, or None
+            max_bytes:  size of the stored files above which the least
+                        recently used results are deleted.  Default
+                        is 1 GB.
+    """
+
+    if directory is not None:
+        os.makedirs(directory, exist_ok=True)
+
+    _state['directory'] = directory
+    _state['max_bytes'] = max_bytes
+
+
+def get_cache():
+    """
+        get_cache()
+            Returns the directory (None if caching is off) and
+            max_bytes of the cache, as a tuple.
+    """
+
+    return _state['directory'], _state['max_bytes']
+
+
+@contextmanager
+def use(directory, max_bytes=2**30):
+    """
+        use(directory, max_bytes=2**30)
+            Context manager that sets the cache (see set_cache) for the
+            calls made inside it, then restores the previous one.
+    """
+
+    previous = dict(_state)
+    set_cache(directory, max_bytes)
+    try:
+        yield
+    finally:
+        _state.update(previous)
+
+
+def stats():
+    """
+        stats()
+            The counters of this process since the last reset_stats(),
+            and the current contents of the cache.
+
+        Returns
+        -------
+            dict of
+                'hits':       calls answered from the cache
+                'misses':     calls computed (and stored)
+                'stores':     results written
+                'evictions':  results deleted to stay under max_bytes
+                'entries':    results in the cache
+                'bytes':      size of their files
+    """
+
+    entries = _entries()
+    counts = dict(_stats)
+    counts['entries'] = len(entries)
+    counts['bytes'] = sum(size for path, size, mtime in entries)
+
+    return counts
+
+
+def reset_stats():
+    """
+        reset_stats()
+            Sets the hit, miss, store and eviction counters to 0.
+    """
+
+    for name in _stats:
+        _stats[name] = 0
+
+
+def clear():
+    """
+        clear()
+            Deletes every result in the cache.
+    """
+
+    for path, size, mtime in _entries():
+        shutil.rmtree(path, ignore_errors=True)
+
+
+def cached(name):
+    """
+        cached(name)
+            Decorator that looks up the results of a transform in the
+            cache before computing them, and stores them after, while
+            a cache directory is set.  name is part of the key, so it
+            must be unique to the function.
+    """
+
+    def decorator(func):
+        signature = inspect.signature(func)
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if _state['directory'] is None or getattr(_local, 'depth', 0):
+                return func(*args, **kwargs)
+
+            arguments = signature.bind(*args, **kwargs)
+            arguments.apply_defaults()
+            if arguments.arguments.get('out') is not None:
+                return func(*args, **kwargs)
+
+            with instrument.stage('cache') as s:
+                key = _key(name, arguments.arguments)
+                result = _load(key)
+                s.output(result)
+            if result is not None:
+                _stats['hits'] += 1
+                return result
+
+            _stats['misses'] += 1
+            _local.depth = 1
+            try:
+                result = func(*args, **kwargs)
+            finally:
+                _local.depth = 0
+            _store(key, result)
+
+            return result
+
+        return wrapper
+
+    return decorator
+
+
+def _key(name, arguments):
+    # Hex digest of the transform's name, the library version, the FFT
+    # backend (whose rounding and float32 handling differ) and every
+    # argument but _unkeyed.  Arrays are hashed by dtype, shape and
+    # contents; other values by repr.  SHA-256 is the fastest of
+    # hashlib's on CPUs with SHA instructions (about 1 GB/s), so a hit
+    # costs about 1 ms per 20 s of mono audio plus the mapping of the
+    # files.
+
+    h = hashlib.sha256()
+    h.update(('%s %s %s' % (name, __version__,
+                            fft_backend.get_backend()[0])).encode())
+    for arg, value in arguments.items():
+        if arg in _unkeyed:
+            continue
+        h.update(('\0%s=' % arg).encode())
+        _hash_value(h, value)
+
+    return h.hexdigest()
+
+
+def _hash_value(h, value):
+    if isinstance(value, np.ndarray):
+        a = np.ascontiguousarray(value)
+        h.update(('array %s %s:' % (a.dtype.str, a.shape)).encode())
+        if a.dtype.hasobject:
+            h.update(repr(a.tolist()).encode())
+        else:
+            h.update(a.reshape(-1).view(np.uint8))
+    elif isinstance(value, (list, tuple)):
+        h.update(('%s %d:' % (type(value).__name__, len(value))).encode())
+        for item in value:
+            _hash_value(h, item)
+    else:
+        h.update(repr(value).encode())
+
+
+def _load(key):
+    # The stored result, as copy-on-write memory maps, or None
+
+    path = os.path.join(_state['directory'], key)
+    try:
+        names = os.listdir(path)
+        kind = names[0].split('-')[0]
+        names.sort(key=lambda n: int(n.split('-')[1].split('.')[0]))
+        items = [np.load(os.path.join(path, n), mmap_mode='c')
+                 for n in names]
+
+        # Marks the result as recently used
+        os.utime(path)
+    except (OSError, IndexError, ValueError):
+        # Not stored, or deleted by another process meanwhile
+        return None
+
+    if kind == 'array':
+        return items[0]
+    if kind == 'list':
+        return items
+
+    return tuple(items)
+
+
+def _store(key, result):
+    # Writes a result (an array, or a tuple or list of arrays) to a
+    # temporary directory that is then renamed to its key, so that other
+    # processes never see it half written.  Results larger than the
+    # cache are not stored.
+
+    if isinstance(result, tuple):
+        kind, items = 'tuple', list(result)
+    elif isinstance(result, list):
+        kind, items = 'list', result
+    else:
+        kind, items = 'array', [result]
+
+    if not items or not all(isinstance(a, np.ndarray) for a in items):
+        return
+    if sum(a.nbytes for a in items) > _state['max_bytes']:
+        return
+
+    directory = _state['directory']
+    with instrument.stage('cache_store'):
+        tmp = tempfile.mkdtemp(prefix='.tmp-', dir=directory)
+        try:
+            for i, a in enumerate(items):
+                np.save(os.path.join(tmp, '%s-%d.npy' % (kind, i)), a)
+            os.rename(tmp, os.path.join(directory, key))
+        except OSError:
+            # Stored by another process first (or the disk is full)
+            shutil.rmtree(tmp, ignore_errors=True)
+            return
+
+    _stats['stores'] += 1
+    _evict()
+
+
+def _entries():
+    # (path, bytes, last use) of every stored result
+
+    directory = _state['directory']
+    if directory is None:
+        return []
+
+    entries = []
+    for entry in os.scandir(directory):
+        if entry.name.startswith('.') or not entry.is_dir():
+            continue
+        try:
+            size = sum(f.stat().st_size for f in os.scandir(entry.path))
+            entries.append((entry.path, size, entry.stat().st_mtime))
+        except OSError:
+            continue
+
+    return entries
+
+
+def _evict():
+    # Deletes the least recently used results until the cache fits in
+    # max_bytes
+
+    entries = _entries()
+    total = sum(size for path, size, mtime in entries)
+    if total <= _state['max_bytes']:
+        return
+
+    for path, size, mtime in sorted(entries, key=lambda e: e[2]):
+        if total <= _state['max_bytes']:
+            break
+        shutil.rmtree(path, ignore_errors=True)
+        total -= size
+        _stats['evictions'] += 1
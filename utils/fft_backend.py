@@ -0,0 +1,148 @@
+'''
+Author: Dan Valente
+
+FFT backend used by all transforms and filter banks.  The backend and
+number of worker threads can be set globally with set_backend, or for a
+block of calls with the use context manager:
+
+    from pythagoras.utils import fft_backend
+    fft_backend.set_backend('scipy', workers=8)
+
+    with fft_backend.use('pyfftw', workers=-1):
+        S, freq, time = stft(x)
+
+Backends are:
+    scipy:    scipy.fft (default). Multidimensional (e.g. batched STFT)
+              transforms are split over the worker threads.
+    numpy:    numpy.fft. Single threaded; workers is ignored.
+    pyfftw:   pyFFTW's scipy.fft interface with its plan cache enabled,
+              if pyFFTW is installed.
+
+Backend modules are imported when first used, so the default scipy.fft
+is only loaded by the first FFT.
+'''
+
+from contextlib import contextmanager
+
+import numpy as np
+from pythagoras.utils import instrument
+
+# module is None until the first FFT, when the named backend is loaded
+_state = {'name': 'scipy', 'module': None, 'workers': -1}
+
+
+def set_backend(name, workers=None):
+    """
+        set_backend(name, workers=None)
+            Selects the FFT backend for all later calls.
+
+        Input
+        -----
+            name:       'scipy', 'numpy' or 'pyfftw'
+            workers:    number of threads for the scipy and pyfftw
+                        backends. -1 (the default) uses all cores.
+    """
+
+    _state['module'] = _load(name)
+    _state['name'] = name
+    _state['workers'] = -1 if workers is None else workers
+
+
+def get_backend():
+    """
+        get_backend()
+            Returns the name and number of workers of the current
+            backend, as a tuple.
+    """
+
+    return _state['name'], _state['workers']
+
+
+@contextmanager
+def use(name, workers=None):
+    """
+        use(name, workers=None)
+            Context manager that selects a backend (see set_backend)
+            for the calls made inside it, then restores the previous
+            one.
+    """
+
+    previous = dict(_state)
+    set_backend(name, workers)
+    try:
+        yield
+    finally:
+        _state.update(previous)
+
+
+def fft(x, n=None, axis=-1):
+    """ Complex FFT of x along axis, zero padded or truncated to n """
+    return _call('fft', x, n, axis)
+
+
+def ifft(x, n=None, axis=-1):
+    """ Inverse complex FFT of x along axis """
+    return _call('ifft', x, n, axis)
+
+
+def rfft(x, n=None, axis=-1):
+    """ One-sided FFT of real x along axis (n/2+1 bins) """
+    return _call('rfft', x, n, axis)
+
+
+def irfft(x, n=None, axis=-1):
+    """ Inverse of rfft, giving n real samples along axis """
+    return _call('irfft', x, n, axis)
+
+
+def dct(x, type=2, n=None, axis=-1):
+    """ Discrete cosine transform, as in scipy.fft.dct """
+
+    module = _module()
+    if module is np.fft or not hasattr(module, 'dct'):
+        # numpy has no DCT
+        module = _load('scipy')
+
+    with instrument.stage('dct') as s:
+        return s.output(module.dct(x, type, n, axis,
+                                   workers=_state['workers']))
+
+
+def _load(name):
+    # Imports the module of the named backend
+
+    if name == 'scipy':
+        import scipy.fft
+        module = scipy.fft
+    elif name == 'numpy':
+        module = np.fft
+    elif name == 'pyfftw':
+        try:
+            import pyfftw
+            import pyfftw.interfaces.scipy_fft
+        except ImportError:
+            raise ImportError("The pyfftw backend requires pyFFTW")
+        pyfftw.interfaces.cache.enable()
+        module = pyfftw.interfaces.scipy_fft
+    else:
+        raise ValueError("Unknown FFT backend '%s'. Choices are: "
+                         "scipy, numpy, pyfftw" % name)
+
+    return module
+
+
+def _module():
+    if _state['module'] is None:
+        _state['module'] = _load(_state['name'])
+
+    return _state['module']
+
+
+def _call(func, x, n, axis):
+    module = _module()
+    with instrument.stage(func) as s:
+        if module is np.fft:
+            return s.output(getattr(module, func)(x, n, axis))
+
+        return s.output(getattr(module, func)(x, n, axis,
+                                              workers=_state['workers']))
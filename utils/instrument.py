@@ -0,0 +1,339 @@
+'''
+Author: Dan Valente
+
+Opt-in instrumentation of the stages inside the transforms and filter
+banks: taper and kernel construction, FFTs, filter bank products and
+so on.  Each stage is recorded with its wall time, the shape and size
+of its output and, if tracemalloc is tracing, the bytes it allocated at
+its peak.  Stages nest, and are named by their path, e.g.
+'cqt/stft/tfft/rfft' is the FFT inside the STFT inside cqt.
+
+Nothing is recorded (and the cost is one flag check per stage) unless a
+recorder or hook is active.  To collect statistics for a block of
+calls:
+
+    from pythagoras.utils import instrument
+
+    with instrument.record(memory=True) as rec:
+        C = cqt(x)
+    rec.to_dict()     # or rec.to_json(), or rec.log()
+
+or to receive every stage of every call as it finishes:
+
+    instrument.add_hook(instrument.log_hook())
+'''
+
+from contextlib import contextmanager
+from functools import wraps
+import json
+import logging
+import threading
+import time
+import tracemalloc
+
+_recorders = []
+_hooks = []
+_enabled = False
+_local = threading.local()
+
+
+class Recorder(object):
+    """
+        Recorder(memory=False)
+            Collects statistics of the stages that run while it is
+            active.  Made by record().
+
+            stats maps each stage path to a dict of
+                calls:          number of times the stage ran
+                seconds:        total wall time
+                max_seconds:    longest single run
+                nbytes:         total size of the stage's outputs
+                shape:          shape of the last output (None if the
+                                stage returns no array)
+                alloc_bytes:    most bytes allocated at the peak of one
+                                run (None unless tracing memory)
+    """
+
+    def __init__(self, memory=False):
+        self.memory = memory
+        self.stats = {}
+
+    def add(self, event):
+        """
+            add(event)
+                Adds one finished stage (an event, as passed to hooks).
+        """
+
+        stat = self.stats.get(event['stage'])
+        if stat is None:
+            stat = self.stats[event['stage']] = {
+                'calls': 0, 'seconds': 0., 'max_seconds': 0., 'nbytes': 0,
+                'shape': None, 'alloc_bytes': None}
+
+        stat['calls'] += 1
+        stat['seconds'] += event['seconds']
+        stat['max_seconds'] = max(stat['max_seconds'], event['seconds'])
+        stat['nbytes'] += event['nbytes']
+        if event['shape'] is not None:
+            stat['shape'] = event['shape']
+        if event['alloc_bytes'] is not None:
+            stat['alloc_bytes'] = max(stat['alloc_bytes'] or 0,
+                                      event['alloc_bytes'])
+
+    def reset(self):
+        """
+            reset()
+                Discards all statistics.
+        """
+        self.stats = {}
+
+    def to_dict(self):
+        """
+            to_dict()
+                Returns the statistics as a dict of dicts, ordered by
+                stage path.
+        """
+
+        return dict((stage, dict(self.stats[stage]))
+                    for stage in sorted(self.stats))
+
+    def to_json(self, **kwargs):
+        """
+            to_json(**kwargs)
+                Returns the statistics as a JSON string.  kwargs are
+                passed to json.dumps.
+        """
+
+        return json.dumps(self.to_dict(), **kwargs)
+
+    def log(self, logger=None, level=logging.INFO):
+        """
+            log(logger=None, level=logging.INFO)
+                Logs one line per stage.  Default logger is
+                'pythagoras.instrument'.  Each record also carries the
+                stage's statistics as the 'pythagoras' attribute, for
+                structured log handlers.
+        """
+
+        if logger is None:
+            logger = logging.getLogger('pythagoras.instrument')
+
+        for stage, stat in self.to_dict().items():
+            logger.log(level, '%s: %d calls, %.6f s, %d bytes out%s',
+                       stage, stat['calls'], stat['seconds'], stat['nbytes'],
+                       '' if stat['alloc_bytes'] is None
+                       else ', %d bytes allocated' % stat['alloc_bytes'],
+                       extra={'pythagoras': dict(stat, stage=stage)})
+
+
+@contextmanager
+def record(memory=False):
+    """
+        record(memory=False)
+            Context manager that records the stages run inside it.
+
+        Input
+        -----
+            memory:   if True, tracemalloc is started (if not already
+                      tracing) so that allocations are recorded too.
+                      This slows the calls down considerably.
+
+        Returns
+        -------
+            a Recorder
+    """
+
+    rec = Recorder(memory)
+    started = memory and not tracemalloc.is_tracing()
+    if started:
+        tracemalloc.start()
+
+    _recorders.append(rec)
+    _update()
+    try:
+        yield rec
+    finally:
+        _recorders.remove(rec)
+        _update()
+        if started:
+            tracemalloc.stop()
+
+
+def add_hook(hook):
+    """
+        add_hook(hook)
+            Calls hook(event) after every stage from now on, with event
+            a dict of
+                stage:          the stage path
+                seconds:        wall time
+                shape, nbytes:  shape and size of the output (None and
+                                0 if there is no array output)
+                alloc_bytes:    bytes allocated at the peak of the
+                                stage, if tracemalloc is tracing, else
+                                None
+    """
+
+    _hooks.append(hook)
+    _update()
+
+
+def remove_hook(hook):
+    """
+        remove_hook(hook)
+            Removes a hook added by add_hook.
+    """
+
+    _hooks.remove(hook)
+    _update()
+
+
+def log_hook(logger=None, level=logging.DEBUG):
+    """
+        log_hook(logger=None, level=logging.DEBUG)
+            Returns a hook (see add_hook) that logs every event.
+            Default logger is 'pythagoras.instrument'.
+    """
+
+    if logger is None:
+        logger = logging.getLogger('pythagoras.instrument')
+
+    def hook(event):
+        logger.log(level, '%s: %.6f s, %s, %d bytes', event['stage'],
+                   event['seconds'], event['shape'], event['nbytes'],
+                   extra={'pythagoras': event})
+
+    return hook
+
+
+def stage(name):
+    """
+        stage(name)
+            Context manager around one stage of a transform.  Call
+            output(value) on it to record the size of the stage's
+            result.  Does nothing unless instrumentation is enabled.
+
+            with instrument.stage('window') as s:
+                xw = s.output(w * x)
+    """
+
+    if not _enabled:
+        return _null
+
+    return _Stage(name)
+
+
+def timed(name):
+    """
+        timed(name)
+            Decorator recording every call of a function as a stage,
+            with the function's return value (or the first element of
+            a returned tuple) as its output.
+    """
+
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return func(*args, **kwargs)
+            with _Stage(name) as s:
+                return s.output(func(*args, **kwargs))
+
+        return wrapper
+
+    return decorator
+
+
+def _update():
+    global _enabled
+    _enabled = bool(_recorders or _hooks)
+
+
+def _stack():
+    stack = getattr(_local, 'stack', None)
+    if stack is None:
+        stack = _local.stack = []
+
+    return stack
+
+
+def _nbytes(value):
+    if hasattr(value, 'nbytes'):
+        return value.nbytes
+
+    # scipy.sparse matrices
+    return sum(getattr(value, a).nbytes for a in ('data', 'indices', 'indptr')
+               if hasattr(value, a))
+
+
+class _NullStage(object):
+    # Stand-in for _Stage when instrumentation is disabled
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def output(self, value):
+        return value
+
+
+_null = _NullStage()
+
+
+class _Stage(object):
+
+    def __init__(self, name):
+        self.name = name
+        self.shape = None
+        self.nbytes = 0
+
+    def output(self, value):
+        array = value[0] if isinstance(value, tuple) and value else value
+        if hasattr(array, 'shape'):
+            self.shape = tuple(array.shape)
+            self.nbytes = int(_nbytes(array))
+
+        return value
+
+    def __enter__(self):
+        stack = _stack()
+        self.path = (stack[-1].path + '/' if stack else '') + self.name
+
+        # tracemalloc has a single peak, so each stage resets it on
+        # entry, and hands the peak it saw on to its parent on exit
+        self.tracing = tracemalloc.is_tracing()
+        if self.tracing:
+            current, peak = tracemalloc.get_traced_memory()
+            if stack and stack[-1].tracing:
+                stack[-1].peak = max(stack[-1].peak, peak)
+            self.start = current
+            self.peak = current
+            tracemalloc.reset_peak()
+
+        stack.append(self)
+        self.t0 = time.perf_counter()
+
+        return self
+
+    def __exit__(self, *exc):
+        seconds = time.perf_counter() - self.t0
+
+        stack = _stack()
+        stack.pop()
+
+        alloc_bytes = None
+        if self.tracing and tracemalloc.is_tracing():
+            peak = max(self.peak, tracemalloc.get_traced_memory()[1])
+            alloc_bytes = peak - self.start
+            if stack and stack[-1].tracing:
+                stack[-1].peak = max(stack[-1].peak, peak)
+
+        event = {'stage': self.path, 'seconds': seconds, 'shape': self.shape,
+                 'nbytes': self.nbytes, 'alloc_bytes': alloc_bytes}
+        for rec in list(_recorders):
+            rec.add(event)
+        for hook in list(_hooks):
+            hook(event)
+
+        return False
@@ -4,9 +4,13 @@ Last modified: 2013-11-06
 
 '''
 
+from functools import lru_cache
+
 import numpy as np
-import matplotlib.pyplot as plt
-import scipy.io.wavfile as wv
+from pythagoras.utils import instrument
+
+# matplotlib and scipy.io are imported by the functions that use them,
+# so that importing the transforms does not pay for them
 
 def freq2mel(f):
     """
@@ -75,19 +79,20 @@ def get_taper(taper_name, N, param=1):
                               blackman
                               kaiser
                               gabor
+                              mtm (multitaper, see dpss)
             N:            length of the taper
             param:        if a taper requires parameters, they should
-                          be input here.  Currently only supports the
-                          alpha paramter of the Gabor taper
-                          (as of 2013-11-07)
+                          be input here.  The alpha paramter of the
+                          Gabor taper, the beta of the Kaiser, or for
+                          mtm the time-halfbandwidth product NW, or a
+                          tuple (NW, K).  See dpss.
 
         Returns
         -------
-            taper     [Length N np.array]
+            taper     [Length N np.array, or size (K, N) for mtm]
 
     """
 
-    # TODO: Add in multitaper method
     # TODO: Should Gabor variance parameter be hard-coded?
 
     if taper_name == 'rect':
@@ -104,14 +109,195 @@ def get_taper(taper_name, N, param=1):
         return np.exp(-np.pi
                       * ((np.linspace(0, N, N) - N/2) / param) ** 2)
     elif taper_name == 'mtm':
-        return 'unfinished'
+        return dpss(N, *_mtm_params(param))[0]
+
+
+@lru_cache(maxsize=64)
+@instrument.timed('taper')
+def normalized_taper(taper_name, N, param=None, dtype=None):
+    """
+        normalized_taper(taper_name, N, param=None, dtype=None)
+            Returns the taper from get_taper, scaled to unit sum, as
+            used by tfft.  Results are cached on the arguments, so
+            repeated calls with the same frame size (e.g. every frame
+            of an STFT) reuse one array.
+
+        Input
+        -----
+            taper_name:   name of the taper. See get_taper.
+            N:            length of the taper
+            param:        taper parameter. See get_taper.
+            dtype:        float dtype of the taper. Default is float64.
+
+        Returns
+        -------
+            taper     [Length N np.array, read-only]
+
+    """
+
+    if taper_name == 'mtm':
+        raise ValueError("mtm is a set of tapers, which cannot be "
+                         "normalized to unit sum. See dpss.")
+
+    taper = get_taper(taper_name, N, param)
+    w = taper / sum(taper)
+    if dtype is not None:
+        w = w.astype(dtype)
+    w.setflags(write=False)
+
+    return w
+
+
+def _mtm_params(param=None):
+    # The (NW, K) of a multitaper taper_param: None for NW=4, a number
+    # NW, or a tuple (NW, K).  K defaults to 2*NW - 1, the tapers whose
+    # spectral concentration is close to 1.
+
+    if param is None:
+        param = 4
+    if np.ndim(param) == 0:
+        NW = float(param)
+        K = max(1, int(2 * NW) - 1)
+    else:
+        NW, K = param
+        NW, K = float(NW), int(K)
+
+    return NW, K
+
+
+@lru_cache(maxsize=16)
+@instrument.timed('dpss')
+def dpss(N, NW=4, K=None, dtype=None):
+    """
+        dpss(N, NW=4, K=None, dtype=None)
+            Discrete prolate spheroidal sequences (Slepian tapers), the
+            tapers of the multitaper method.  They are the K sequences
+            of length N whose energy is most concentrated in the band
+            |f| < NW/N.  Results are cached on the arguments, so the
+            tapers are only computed once for every frame of an STFT.
+
+        Input
+        -----
+            N:        length of the tapers
+            NW:       time-halfbandwidth product
+            K:        number of tapers. Default is 2*NW - 1.
+            dtype:    float dtype of the tapers. Default is float64.
+
+        Returns
+        -------
+            (tapers, ratios)
+                tapers:   size (K, N), each with unit energy
+                          (read-only)
+                ratios:   the concentration ratio (eigenvalue) of
+                          each taper, size (K,) (read-only)
+
+        [REF]
+        Slepian D (1978). Prolate spheroidal wave functions, Fourier
+        analysis, and uncertainty - V: The discrete case. Bell System
+        Technical Journal 57(5):1371-1430
+    """
+
+    # scipy.signal is slow to import, so it is imported on first use
+    from scipy.signal.windows import dpss as scipy_dpss
+
+    if K is None:
+        K = _mtm_params(NW)[1]
+
+    tapers, ratios = scipy_dpss(N, NW, K, return_ratios=True)
+    tapers = np.atleast_2d(tapers)
+    ratios = np.atleast_1d(ratios)
+    if dtype is not None:
+        tapers = tapers.astype(dtype)
+    tapers.setflags(write=False)
+    ratios.setflags(write=False)
+
+    return tapers, ratios
+
+
+def frame(x, frame_size, step_size):
+    """
+        frame(x, frame_size, step_size)
+            Splits a signal into overlapping frames without copying.
+            Frame i starts at sample i*step_size.  As in stft, only
+            frames that start before len(x) - frame_size are kept.
+
+        Input
+        -----
+            x:            the waveform to frame, or several of the same
+                          length, size (..., n_samples), which are all
+                          framed along the last axis
+            frame_size:   the size of a frame in samples
+            step_size:    the 'hop' between frame starts in samples
+
+        Returns
+        -------
+            frames    [np.array view, size (n_frames, frame_size), or
+                       (..., n_frames, frame_size), read-only]
+
+    """
+
+    x = np.asarray(x)
+    n_frames = len(range(0, x.shape[-1] - frame_size, step_size))
+    if n_frames == 0:
+        return np.zeros(x.shape[:-1] + (0, frame_size), dtype=x.dtype)
+
+    frames = np.lib.stride_tricks.sliding_window_view(x, frame_size, axis=-1)
+
+    return frames[..., :(n_frames - 1) * step_size + 1:step_size, :]
+
+
+def _bank_product(bank, X):
+    # The product of a (dense or sparse) filter bank or kernel, size
+    # (n_filters, n_bins), with X, size (n_bins,) or (n_bins, n_frames),
+    # or with every matrix of a stack (..., n_bins, n_frames).  A stack
+    # is laid side by side as the columns of one matrix, so that the
+    # bank is applied in a single product.
+
+    if X.ndim <= 2:
+        return bank.dot(X)
+
+    lead = X.shape[:-2]
+    n_bins, n_frames = X.shape[-2:]
+    Y = bank.dot(np.moveaxis(X, -2, 0).reshape(n_bins, -1))
+
+    return np.moveaxis(Y.reshape((Y.shape[0],) + lead + (n_frames,)), 0, -2)
+
+
+def output_array(out, shape, dtype):
+    """
+        output_array(out, shape, dtype)
+            Prepares the out argument of a transform.
+
+        Input
+        -----
+            out:      name of a .npy file to create, as a memory map in
+                      Fortran order (so that blocks of columns, e.g.
+                      STFT frames, are contiguous on disk), or an
+                      existing array or np.memmap
+            shape:    the required shape
+            dtype:    the dtype of a new file
+
+        Returns
+        -------
+            the array to write to
+    """
+
+    if isinstance(out, str):
+        return np.lib.format.open_memmap(out, mode='w+', dtype=dtype,
+                                         shape=shape, fortran_order=True)
+
+    if out.shape != tuple(shape):
+        raise ValueError("out has shape %s, but %s is needed"
+                         % (out.shape, tuple(shape)))
+
+    return out
 
 
 def plot_spectrogram(time, freq, X, fpass=None, tpass=None,
-                     cmap_name='jet', log_plot=False):
+                     cmap_name='jet', log_plot=False, one_sided=False):
     """
         plot_spectrogram(time,freq,X,fpass=None,tpass=None,
-                  cmap_name='jet',log_plot = False)
+                  cmap_name='jet',log_plot = False, one_sided=False)
 
             Plots the power spectrogram of the STFT.
 
@@ -126,17 +312,28 @@ def plot_spectrogram(time, freq, X, fpass=None, tpass=None,
                 cmap_name:    name of the color map to use.  See
                               documentation from matplotlib color maps
                 log_plot:     if True, then 10*log10(P) will be displayed
+                one_sided:    set to True if X (and freq) come from
+                              stft(one_sided=True), which are already
+                              one-sided and doubled
     """
 
+    import matplotlib.pyplot as plt
+
     #plotting one-sided spectrogram, so multiply X by 2
 
-    S = np.power(np.abs(2 * X), 2)
+    if one_sided:
+        S = np.power(np.abs(X), 2)
+    else:
+        S = np.power(np.abs(2 * X), 2)
 
     if log_plot:
         S = 10 * np.log10(S)
 
     if fpass is None:
-        fpass = [freq[0], freq[-1]/2]
+        if one_sided:
+            fpass = [freq[0], freq[-1]]
+        else:
+            fpass = [freq[0], freq[-1]/2]
 
     if tpass is None:
         tpass = [time[0], time[-1]]
@@ -159,7 +356,77 @@ def plot_spectrogram(time, freq, X, fpass=None, tpass=None,
 def write_to_wav(x, fs=44100, filename='test'):
     # TODO: Documentation
 
+    import scipy.io.wavfile as wv
+
     #Normalizes to max amplitude, ensures writable data type
     x = x/np.max(x)
     x = np.asarray(x, dtype=np.float32)
     wv.write(filename, fs, x)
+
+
+def mmap_wav(filename):
+    """
+        mmap_wav(filename)
+            Memory-maps the samples of a WAV file without reading or
+            copying them, so files larger than memory can be passed to
+            stft, cqt or StreamSTFT.  Only PCM int16/int32 and float
+            data can be mapped.  The samples keep their stored dtype
+            (they are not scaled as in read_wav).
+
+        Input
+        -----
+            filename:   path of the WAV file
+
+        Returns
+        -------
+            (x, fs)
+                x:      copy-on-write np.memmap of the samples
+                        (changes are never written to the file), size
+                        (n_samples,) or (n_samples, n_channels).  Take
+                        x[:, c] for channel c.
+                fs:     the sample rate
+    """
+
+    import scipy.io.wavfile as wv
+
+    fs, x = wv.read(filename, mmap=True)
+
+    return x, fs
+
+
+def read_wav(filename, mono=True):
+    """
+        read_wav(filename, mono=True)
+            Reads a WAV file as floating point samples.  Integer PCM
+            data is scaled to [-1, 1).
+
+        Input
+        -----
+            filename:   path of the WAV file
+            mono:       if True, multichannel files are mixed down to
+                        one channel by averaging
+
+        Returns
+        -------
+            (x, fs)
+                x:      the waveform [np.array, size (n_samples,) or
+                        (n_samples, n_channels) if not mono]
+                fs:     the sample rate
+    """
+
+    import scipy.io.wavfile as wv
+
+    fs, x = wv.read(filename)
+
+    if np.issubdtype(x.dtype, np.integer):
+        if x.dtype == np.uint8:
+            x = (x.astype(float) - 128) / 128.
+        else:
+            x = x / float(-np.iinfo(x.dtype).min)
+    else:
+        x = x.astype(float)
+
+    if mono and x.ndim > 1:
+        x = np.mean(x, axis=1)
+
+    return x, fs